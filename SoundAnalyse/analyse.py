@@ -10,6 +10,7 @@ Released under the LGPL
 
 '''
 
+import array
 import numpy
 import math
 
@@ -25,13 +26,187 @@ def loudness(chunk):
     be -1dB, typical silence is -36dB.
 
     '''
-    data = numpy.array(chunk, dtype=float) / 32768.0
-    ms = math.sqrt(numpy.sum(data ** 2.0) / len(data))
+    data = numpy.asarray(chunk)
+    if data.dtype == numpy.int16:
+        # exact integer sum, gives the same result as the float version
+        ms = math.sqrt(_sum_squares(data) / float(len(data))) / 32768.0
+    else:
+        data = numpy.array(chunk, dtype=float) / 32768.0
+        ms = math.sqrt(numpy.sum(data ** 2.0) / len(data))
     if ms < 10e-8: ms = 10e-8
     return 10.0 * math.log(ms, 10.0)
 
+def _sum_squares(data):
+    '''Return sum of squares of samples along the last axis'''
+    # products are done in int64 (float64 for floating point samples)
+    # without converting the whole array
+    if data.dtype.kind == 'f':
+        return numpy.einsum('...i,...i->...', data, data, dtype=numpy.float64)
+    return numpy.einsum('...i,...i->...', data, data, dtype=numpy.int64)
+
+def _loudness_samples(chunk):
+    '''Return chunk as an int16 or floating point numpy array'''
+    data = numpy.asarray(chunk)
+    if data.dtype.kind != 'f':
+        data = numpy.asarray(data, dtype=numpy.int16)
+    return data
+
+def loudness_batch(frames):
+    '''Return loudness of each row of a 2D array of samples
+
+    frames is a numpy array of 16-bit mono samples with one chunk per
+    row.  Floating point samples are taken on the same scale, as
+    loudness() does.  Returns a numpy array with the same values
+    loudness() would give for each row.
+
+    '''
+    data = _loudness_samples(frames)
+    if data.dtype.kind == 'f':
+        # same operations as loudness(), row by row
+        data = numpy.array(data, dtype=float) / 32768.0
+        ms = numpy.sqrt(numpy.sum(data ** 2.0, axis=-1) / data.shape[-1])
+    else:
+        ms = numpy.sqrt(_sum_squares(data) / float(data.shape[-1])) / 32768.0
+    ms = numpy.maximum(ms, 10e-8)
+    return 10.0 * (numpy.log(ms) / math.log(10.0))
+
+
+# Loudness levels of 400ms blocks are kept in a histogram from the
+# absolute gate at -70 up to 0, in steps of 0.1
+_GATE = -70.0
+_BINS_PER_UNIT = 10
+
+class LoudnessMeter:
+    '''Measure the loudness of a stream of sampled sound
+
+    Samples can be fed in chunks of any size.  Only running sums are
+    kept, so queries never scan the samples seen before.  Measures
+    RMS, peak, and LUFS-style momentary (400ms), short-term (3s) and
+    gated integrated loudness.  The LUFS-style values follow the
+    gating of ITU-R BS.1770 (absolute gate at -70, relative gate 10
+    below) but without its K-weighting filter.  They are in dB
+    relative to full scale, a full scale sine wave is about -3.7.
+
+    Keyword arguments:
+    samplerate - sampling frequency of input (Hz) (default: 44100)
+
+    '''
+    def __init__(self, samplerate=44100):
+        self.samplerate = samplerate
+        # energy is summed in 100ms steps, the last 30 cover 3 seconds
+        self.step = int(samplerate / 10)
+        # int16 sums of a step are exact in float64
+        self.steps = numpy.zeros(30)
+        nbins = int(-_GATE * _BINS_PER_UNIT)
+        self.hist_energy = numpy.zeros(nbins)
+        self.hist_count = numpy.zeros(nbins, dtype=numpy.int64)
+        self.reset()
+
+    def reset(self):
+        '''Forget everything measured so far'''
+        self.count = 0
+        self.total = 0
+        self.peak_value = 0
+        self.partial = 0
+        self.fill = 0
+        self.nsteps = 0
+        self.steps.fill(0)
+        self.hist_energy.fill(0.0)
+        self.hist_count.fill(0)
+
+    def feed(self, chunk):
+        '''Add samples to the measurement
 
-def detect_pitch(chunk, min_frequency=82.0, max_frequency=1000.0, samplerate=44100.0, sens=0.1, ratio=5.0):
+        chunk is a numpy array of 16-bit mono samples.  Floating point
+        samples are taken on the same scale, as loudness() does.  A 2D
+        array of frames is fed one row after the other.
+
+        '''
+        data = _loudness_samples(chunk).reshape(-1)
+        if len(data) == 0:
+            return
+        if data.dtype.kind == 'f':
+            convert = float
+        else:
+            convert = int
+        self.peak_value = max(self.peak_value, convert(data.max()), -convert(data.min()))
+        pos = 0
+        while pos < len(data):
+            k = min(len(data) - pos, self.step - self.fill)
+            s = convert(_sum_squares(data[pos:pos + k]))
+            self.total += s
+            self.partial += s
+            self.fill += k
+            pos += k
+            if self.fill == self.step:
+                self._end_step()
+        self.count += len(data)
+
+    def _end_step(self):
+        self.steps[self.nsteps % len(self.steps)] = self.partial
+        self.nsteps += 1
+        self.partial = 0
+        self.fill = 0
+        if self.nsteps >= 4:
+            # a new 400ms block, blocks overlap by 75%
+            ms = self._mean_square(4)
+            level = _level(ms)
+            if level > _GATE:
+                b = min(int((level - _GATE) * _BINS_PER_UNIT), len(self.hist_count) - 1)
+                self.hist_energy[b] += ms
+                self.hist_count[b] += 1
+
+    def _mean_square(self, n):
+        # mean square of the last n complete steps, 1.0 is full scale
+        n = min(n, self.nsteps)
+        i = self.nsteps % len(self.steps)
+        total = self.steps[i - n:i].sum() if i >= n else \
+            self.steps[:i].sum() + self.steps[i - n:].sum()
+        return total / (n * self.step * 32768.0 ** 2)
+
+    def rms(self):
+        '''Return RMS of all samples fed, 1.0 is full scale'''
+        if self.count == 0: return 0.0
+        return math.sqrt(self.total / float(self.count)) / 32768.0
+
+    def peak(self):
+        '''Return largest absolute sample fed, 1.0 is full scale'''
+        return self.peak_value / 32768.0
+
+    def momentary(self):
+        '''Return loudness of the last 400ms, or None before 100ms'''
+        if self.nsteps == 0: return None
+        return _level(self._mean_square(4))
+
+    def short_term(self):
+        '''Return loudness of the last 3s, or None before 100ms'''
+        if self.nsteps == 0: return None
+        return _level(self._mean_square(30))
+
+    def integrated(self):
+        '''Return gated loudness of everything fed so far
+
+        Averages the 400ms blocks louder than -70, then averages again
+        only the blocks less than 10 below that.  Returns None when no
+        block was loud enough.  Blocks are binned in steps of 0.1, so
+        the relative gate is applied to that precision.
+
+        '''
+        count = self.hist_count.sum()
+        if count == 0: return None
+        gate = _level(self.hist_energy.sum() / count) - 10.0
+        b = max(0, int(math.ceil((gate - _GATE) * _BINS_PER_UNIT)))
+        count = self.hist_count[b:].sum()
+        if count == 0: return None
+        return _level(self.hist_energy[b:].sum() / count)
+
+def _level(ms):
+    '''Return LUFS-style loudness of a mean square'''
+    if ms <= 0.0: return float('-inf')
+    return -0.691 + 10.0 * math.log10(ms)
+
+
+def detect_pitch(chunk, min_frequency=82.0, max_frequency=1000.0, samplerate=44100.0, sens=0.1, ratio=5.0, method='amdf'):
     '''Return the pitch present in a chunk of sampled sound
 
     The chunk should be a numpy array of samples from the soundcard,
@@ -40,6 +215,11 @@ def detect_pitch(chunk, min_frequency=82.0, max_frequency=1000.0, samplerate=441
     detected.  The chunk should be at least 1024 bytes long for
     accurate pitch detection of lower frequencies.
 
+    Float32 arrays work too, and so does any other object with the
+    buffer interface holding 16-bit or float32 samples, such as an
+    array.array or memoryview.  Contiguous int16 and float32 data is
+    read in place without being copied.
+
     Human vocal range is from about E2 to C6. This corresponds to
     frequencies of approx 82-1000 Hz.  Middle C is C4 at 261.6 Hz.
 
@@ -51,20 +231,198 @@ def detect_pitch(chunk, min_frequency=82.0, max_frequency=1000.0, samplerate=441
            (should be between 0.0 and 1.0, default: 0.1)
     ratio - how good detected pitch much be before being accepted,
             higher numbers are more stringent (default: 5.0)
+    method - 'amdf', 'yin' or 'mpm' (default: 'amdf')
+
+    The 'amdf' method is the original C implementation and returns
+    whole sample periods.  'yin' (de Cheveigne and Kawahara) and 'mpm'
+    (McLeod pitch method) compute their difference functions with
+    FFTs, so they are much faster for long chunks and wide ranges, and
+    interpolate between samples for more precise pitches.
 
     '''
-    chunk2 = chunk.data[:]
-    # Call C function to do work for us
-    dp = analyseffi.detect_pitch(chunk2, min_frequency, max_frequency, samplerate, sens, ratio)
+    if method != 'amdf':
+        x = numpy.asarray(_sample_array(chunk), dtype=float)
+        max_period = int(samplerate / min_frequency + 0.5)
+        min_period = int(samplerate / max_frequency + 0.5)
+        if method == 'yin':
+            period = _yin_period(x, min_period, max_period, sens, ratio)
+        elif method == 'mpm':
+            period = _mpm_period(x, min_period, max_period, sens, ratio)
+        else:
+            raise ValueError('unknown pitch detection method %r' % (method,))
+        if period is None:
+            return None
+        return samplerate / period
+    # Call C function to do work for us, it reads the samples in place
+    dp = analyseffi.detect_pitch(_samples(chunk), min_frequency, max_frequency, samplerate, sens, ratio)
     # Now dp is either None or a number representing an offset
     if dp is not None:
         return samplerate / dp
     return None
 
+def _samples(chunk):
+    '''Return chunk in a form the C code can read without copying'''
+    if isinstance(chunk, array.array):
+        # only has the old buffer interface, which carries no format
+        if chunk.typecode not in ('h', 'f'):
+            raise TypeError('samples must be int16 or float32')
+        return numpy.frombuffer(chunk, dtype=chunk.typecode)
+    if not isinstance(chunk, numpy.ndarray):
+        return chunk
+    if chunk.dtype == numpy.float32 or chunk.dtype == numpy.float64:
+        return numpy.ascontiguousarray(chunk, dtype=numpy.float32)
+    return numpy.ascontiguousarray(chunk, dtype=numpy.int16)
+
+def _sample_array(chunk):
+    '''Return chunk as a numpy array of samples, without copying
+
+    Accepts the same inputs as the C code: byte strings and objects
+    with only the old buffer interface hold 16-bit samples.
+
+    '''
+    x = _samples(chunk)
+    if isinstance(x, numpy.ndarray):
+        return x
+    if isinstance(x, memoryview):
+        return _samples(numpy.asarray(x))
+    return numpy.frombuffer(x, dtype=numpy.int16)
+
+def detect_pitch_batch(frames, hop=None, size=2048, min_frequency=82.0, max_frequency=1000.0, samplerate=44100.0, sens=0.1, ratio=5.0, method='amdf'):
+    '''Return the pitches present in many frames of sampled sound
+
+    frames is either a 2D numpy array with one frame of 16-bit or
+    float32 mono samples per row, or a 1D array holding a long signal, in which
+    case frames of size samples are taken every hop samples.  Returns
+    a numpy array with one frequency in Hz per frame, NaN where no
+    pitch was detected.
+
+    With the 'amdf' method all frames are analysed in one C call
+    that releases the GIL once, so several signals can be analysed
+    at the same time from a pool of threads.
+
+    Keyword arguments:
+    hop - samples between frames of a 1D signal (default: size)
+    size - samples per frame of a 1D signal (default: 2048)
+    Other arguments are the same as for detect_pitch().
+
+    '''
+    data = _samples(frames)
+    if not isinstance(data, numpy.ndarray):
+        data = _samples(numpy.asarray(data))
+    if data.ndim == 2:
+        count, size = data.shape
+        hop = size
+    else:
+        if hop is None:
+            hop = size
+        count = max(0, (len(data) - size) // hop + 1)
+    pitches = numpy.empty(count)
+    pitches.fill(numpy.nan)
+    if method != 'amdf':
+        flat = data.reshape(-1)
+        for f in range(count):
+            p = detect_pitch(flat[f * hop:f * hop + size], min_frequency, max_frequency, samplerate, sens, ratio, method)
+            if p is not None:
+                pitches[f] = p
+        return pitches
+    periods = numpy.zeros(count, dtype=numpy.intc)
+    analyseffi.detect_pitch_batch(data, size, hop, count, min_frequency, max_frequency, samplerate, sens, ratio, periods)
+    found = periods > 0
+    pitches[found] = float(samplerate) / periods[found]
+    return pitches
+
+def _autocorrelation(x, n):
+    '''Return sum of x[j] * x[j + tau] for tau in 0..n-1, using FFT'''
+    size = 1
+    while size < len(x) + n:
+        size *= 2
+    f = numpy.fft.rfft(x, size)
+    return numpy.fft.irfft(f * f.conjugate(), size)[:n]
+
+def _parabolic(y, i):
+    '''Return position of extremum of parabola through y[i-1..i+1]'''
+    if i <= 0 or i >= len(y) - 1:
+        return float(i)
+    a, b, c = y[i - 1], y[i], y[i + 1]
+    d = a - 2.0 * b + c
+    if d == 0.0:
+        return float(i)
+    return i + 0.5 * (a - c) / d
+
+def _yin_period(x, min_period, max_period, sens, ratio):
+    '''Return period of x in samples using YIN, or None'''
+    # difference function over a window that fits every lag
+    w = len(x) - max_period - 1
+    if w <= 0 or min_period < 2:
+        return None
+    n = max_period + 2
+    # cross terms of x[:w] against x, squares from cumulative sums
+    size = 1
+    while size < len(x) + w:
+        size *= 2
+    f = numpy.fft.rfft(x, size) * numpy.fft.rfft(x[:w], size).conjugate()
+    r = numpy.fft.irfft(f, size)[:n]
+    sq = numpy.concatenate(([0.0], numpy.cumsum(x * x)))
+    energy = sq[w:w + n] - sq[:n]
+    d = sq[w] + energy - 2.0 * r
+    # cumulative mean normalized difference
+    d[0] = 0.0
+    total = numpy.cumsum(d[1:])
+    # silence, or a signal that does not change, has no period
+    if sq[w] <= 1e-12 * w or total[-1] <= 1e-9 * sq[w] * n:
+        return None
+    cmnd = numpy.ones(n)
+    cmnd[1:] = d[1:] * numpy.arange(1, n) / numpy.maximum(total, 1e-20)
+    # first dip under the threshold, then follow it down to its bottom
+    search = cmnd[min_period:max_period + 1]
+    below = numpy.nonzero(search < sens)[0]
+    if len(below) > 0:
+        tau = min_period + below[0]
+        while tau < max_period and cmnd[tau + 1] < cmnd[tau]:
+            tau += 1
+    else:
+        tau = min_period + int(numpy.argmin(search))
+        if cmnd[tau] * ratio > 1.0:
+            return None
+    return _parabolic(cmnd, tau)
+
+def _mpm_period(x, min_period, max_period, sens, ratio):
+    '''Return period of x in samples using MPM, or None'''
+    n = min(max_period + 2, len(x))
+    if n <= min_period + 1:
+        return None
+    r = _autocorrelation(x, n)
+    sq = numpy.concatenate(([0.0], numpy.cumsum(x * x)))
+    # m[tau] = sum of x[j]**2 + x[j + tau]**2 over the overlap
+    m = sq[len(x) - numpy.arange(n)] + (sq[-1] - sq[:n])
+    nsdf = 2.0 * r / numpy.maximum(m, 1e-20)
+    # key maxima are the highest points of the positive regions
+    # after the first negative zero crossing
+    neg = numpy.nonzero(nsdf < 0.0)[0]
+    if len(neg) == 0:
+        return None
+    pos = numpy.zeros(n + 1, dtype=numpy.int8)
+    pos[neg[0]:n] = nsdf[neg[0]:] > 0.0
+    edges = numpy.diff(numpy.concatenate(([0], pos)))
+    starts = numpy.nonzero(edges == 1)[0]
+    ends = numpy.nonzero(edges == -1)[0]
+    keys = [a + int(numpy.argmax(nsdf[a:b])) for a, b in zip(starts, ends)]
+    keys = [k for k in keys if min_period <= k <= max_period]
+    if len(keys) == 0:
+        return None
+    best = max([nsdf[k] for k in keys])
+    # clarity too low, no pitch
+    if best < 1.0 - 1.0 / ratio:
+        return None
+    # first key maximum close to the highest, avoids octave errors
+    for k in keys:
+        if nsdf[k] >= (1.0 - sens) * best:
+            return _parabolic(nsdf, k)
+
 
 _previous_pitch = None
 
-def musical_detect_pitch(chunk, min_note=40.0, max_note=84.0, samplerate=44100, sens=0.1, ratio=5.0, smooth=1.0):
+def musical_detect_pitch(chunk, min_note=40.0, max_note=84.0, samplerate=44100, sens=0.1, ratio=5.0, smooth=1.0, method='amdf'):
     '''Return the pitch present in a chunk of sampled sound
 
     The chunk should be a numpy array of samples from the soundcard,
@@ -88,6 +446,11 @@ def musical_detect_pitch(chunk, min_note=40.0, max_note=84.0, samplerate=44100,
     ratio - how good detected pitch much be before being accepted,
             higher numbers are more stringent (default: 5.0)
     smooth - how much to smooth output (default: 1.0)
+    method - pitch detection method, see detect_pitch()
+             (default: 'amdf')
+
+    Smoothing state is shared by all calls, so only use this function
+    for one input at a time.  PitchTracker keeps its own state.
     
     '''
     global _previous_pitch
@@ -96,28 +459,117 @@ def musical_detect_pitch(chunk, min_note=40.0, max_note=84.0, samplerate=44100,
                         max_frequency=pitch_from_midinum(max_note),
                         samplerate=samplerate,
                         sens=sens,
-                        ratio=ratio)
+                        ratio=ratio,
+                        method=method)
+    note, _previous_pitch = _smooth_pitch(midinum_from_pitch(freq), _previous_pitch, smooth)
+    return note
+
+def _smooth_pitch(freq, previous, smooth):
+    '''Return (smoothed note, new previous note) for a detected note'''
     if freq is not None:
-        freq = midinum_from_pitch(freq)
-        if smooth == 0.0: return freq
-        if _previous_pitch is None:
-            _previous_pitch = freq
-        else:
-            # a is weight of new frequency 
-            #   as compared to weight of old freq (which is 1.0)
-            # So if freq changes by smooth, weight old and new equally
-            # Theory is that large pitch changes need to be tracked quickly
-            # Small pitch changes are just noise to be smoothed out
-            a = (freq - _previous_pitch) ** 2.0 / smooth
-            # alpha is 0.0 to 1.0, blend from previous to new freq
-            alpha = 1.0 / (a + 1.0)
-            _previous_pitch = _previous_pitch * alpha + freq * (1.0 - alpha)
-            return _previous_pitch
+        if smooth == 0.0: return freq, previous
+        if previous is None:
+            return None, freq
+        # a is weight of new frequency 
+        #   as compared to weight of old freq (which is 1.0)
+        # So if freq changes by smooth, weight old and new equally
+        # Theory is that large pitch changes need to be tracked quickly
+        # Small pitch changes are just noise to be smoothed out
+        a = (freq - previous) ** 2.0 / smooth
+        # alpha is 0.0 to 1.0, blend from previous to new freq
+        alpha = 1.0 / (a + 1.0)
+        previous = previous * alpha + freq * (1.0 - alpha)
+        return previous, previous
     else:
         # No pitch detected
-        freq = _previous_pitch
-        _previous_pitch = None
-        return freq
+        return previous, None
+
+
+class PitchTracker:
+    '''Track the pitch of a stream of sampled sound
+
+    Samples can be fed in chunks of any size.  They are kept in a ring
+    buffer and analysed in overlapping windows of window samples, one
+    every hop samples, so small input chunks give quick updates while
+    long windows still detect low notes accurately.  Each tracker
+    keeps its own smoothing state, so several inputs (e.g. two
+    singers) can be tracked at once.
+
+    Keyword arguments:
+    window - samples analysed for each estimate (default: 2048)
+    hop - samples between estimates, at most window (default: 512)
+    dtype - type of samples fed, numpy.int16 or numpy.float32
+            (default: numpy.int16)
+    Other arguments are the same as for musical_detect_pitch().
+
+    '''
+    def __init__(self, window=2048, hop=512, min_note=40.0, max_note=84.0, samplerate=44100, sens=0.1, ratio=5.0, smooth=1.0, method='amdf', dtype=numpy.int16):
+        assert 0 < hop <= window
+        self.window = window
+        self.hop = hop
+        self.samplerate = float(samplerate)
+        self.min_frequency = pitch_from_midinum(min_note)
+        self.max_frequency = pitch_from_midinum(max_note)
+        self.sens = sens
+        self.ratio = ratio
+        self.smooth = smooth
+        self.method = method
+        # every sample is stored twice, window apart, so the latest
+        # window is always one contiguous slice
+        self.ring = numpy.zeros(2 * window, dtype=dtype)
+        self.reset()
+
+    def reset(self):
+        '''Forget all samples and smoothing state'''
+        self.count = 0
+        self.next = self.window
+        self.previous = None
+
+    def _write(self, data):
+        n = self.window
+        i = self.count % n
+        first = min(len(data), n - i)
+        self.ring[i:i + first] = data[:first]
+        self.ring[i + n:i + n + first] = data[:first]
+        rest = len(data) - first
+        if rest > 0:
+            self.ring[:rest] = data[first:]
+            self.ring[n:n + rest] = data[first:]
+        self.count += len(data)
+
+    def feed(self, chunk):
+        '''Add samples and return the new pitch estimates
+
+        chunk is a numpy array of mono samples of the tracker's dtype.
+        Returns a list of (time, note) pairs, one for each window
+        completed by the new samples.  time is the center of the
+        window in seconds since the first sample fed, note is a midi
+        note number or None, as returned by musical_detect_pitch().
+
+        '''
+        results = []
+        pos = 0
+        while pos < len(chunk):
+            k = min(len(chunk) - pos, self.next - self.count)
+            self._write(chunk[pos:pos + k])
+            pos += k
+            if self.count == self.next:
+                results.append(self._analyse())
+                self.next += self.hop
+        return results
+
+    def _analyse(self):
+        i = self.count % self.window
+        freq = detect_pitch(self.ring[i:i + self.window],
+                            min_frequency=self.min_frequency,
+                            max_frequency=self.max_frequency,
+                            samplerate=self.samplerate,
+                            sens=self.sens,
+                            ratio=self.ratio,
+                            method=self.method)
+        note, self.previous = _smooth_pitch(midinum_from_pitch(freq), self.previous, self.smooth)
+        t = (self.count - self.window / 2.0) / self.samplerate
+        return (t, note)
 
 def midinum_from_pitch(freq):
     """Return midi note number from pitch
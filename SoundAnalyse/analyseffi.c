@@ -1,58 +1,56 @@
 #include <Python.h>
 #include <stdlib.h>
-#include <limits.h>
+#include <string.h>
+#include <float.h>
 
 /* Copyright 2008, Nathan Whitehead
    Released under the LGPL
 */
 
-static PyObject *detect_pitch(PyObject *self, PyObject *args)
+/* Sample formats accepted for input */
+#define SAMPLES_INT16 0
+#define SAMPLES_FLOAT32 1
+
+/* Find the pitch period of n samples using AMDF
+   kind is SAMPLES_INT16 or SAMPLES_FLOAT32.
+   Returns the period in samples, 0 if no pitch was found or -1 if
+   out of memory.  Does not touch Python objects, so can be called
+   with the GIL released.
+*/
+static int amdf_period(const void *data, int kind, int n,
+                       float min_frequency, float max_frequency,
+                       float samplerate, float sens, float ratio)
 {
-  char *data;
-  signed short int *data2, *datao1, *datao2;
-  int len;
-  float min_frequency, max_frequency, samplerate, sens, ratio;
+  const signed short int *datao1, *datao2;
+  const float *fdatao1, *fdatao2;
   int max_period, min_period;
-  int *amd;
+  double *amd;
   int o, sum, i, d;
-  int minval, maxval;
-  int cutoff;
+  double fsum, fd;
+  double minval, maxval;
+  double cutoff;
   int search_length;
   int minpos;
 
-
   /* Use AMDF strategy
      AMDF (average magnitude difference function)
      Slide data along itself different distances (periods)
      then calculate the AMD.  Find trough in AMD to get period of pitch.
   */
-  if (!PyArg_ParseTuple(args, "s#fffff", 
-                        &data, &len, 
-                        &min_frequency, 
-                        &max_frequency, 
-                        &samplerate, 
-                        &sens,
-                        &ratio))
-      return NULL;
-
-
-  Py_BEGIN_ALLOW_THREADS;
-  
-
-  /* coerce char* into short* */
-  data2 = (signed short int *)data;
 
   /* Longest period we can detect */
   max_period = (int)(samplerate / min_frequency + 0.5);
   /* Shortest period we can detect */
   min_period = (int)(samplerate / max_frequency + 0.5);
-  /* amd is an integer array that holds average magnitude differences
+  /* Nothing to search */
+  if(min_period < 0 || min_period > max_period) return 0;
+  /* amd is an array that holds average magnitude differences
   for each offset value 
   */
 
-  amd = (int *)malloc(sizeof(int) * (max_period + 1)); 
+  amd = (double *)malloc(sizeof(double) * (max_period + 1)); 
   /* add one so amd[max_period] is allowed */
-  if(!amd) return NULL;
+  if(!amd) return -1;
 
   /* Try each offset from min to max and calculate amd */  
   for(o=min_period; o<=max_period; o++) {
@@ -60,15 +58,28 @@ static PyObject *detect_pitch(PyObject *self, PyObject *args)
          so no function calls, uses incremented pointers
          and pointer arithmetic
       */
-      sum = 0;
-      datao1 = data2;
-      datao2 = data2 + o;
-      for(i=0; i<len/2 - o; i++) {
-          d = *(datao1++) - *(datao2++);
-          if(d<0) d = -d;
-          sum += d;
+      if(kind == SAMPLES_INT16) {
+          /* integer sums are exact and fastest */
+          sum = 0;
+          datao1 = (const signed short int *)data;
+          datao2 = datao1 + o;
+          for(i=0; i<n - o; i++) {
+              d = *(datao1++) - *(datao2++);
+              if(d<0) d = -d;
+              sum += d;
+          }
+          amd[o] = sum;
+      } else {
+          fsum = 0.0;
+          fdatao1 = (const float *)data;
+          fdatao2 = fdatao1 + o;
+          for(i=0; i<n - o; i++) {
+              fd = *(fdatao1++) - *(fdatao2++);
+              if(fd<0) fd = -fd;
+              fsum += fd;
+          }
+          amd[o] = fsum;
       }
-      amd[o] = sum;
   }
 
   /* To get pitch, we want to find FIRST minimum
@@ -79,8 +90,8 @@ static PyObject *detect_pitch(PyObject *self, PyObject *args)
   /* Find minimum and maximum values in amd 
      We will use these to determine where to look for "low" troughs
   */
-  minval = INT_MAX;
-  maxval = INT_MIN;
+  minval = DBL_MAX;
+  maxval = -DBL_MAX;
   for(o=min_period; o<=max_period; o++) {
       if(amd[o] < minval) minval = amd[o];
       if(amd[o] > maxval) maxval = amd[o];
@@ -93,7 +104,7 @@ static PyObject *detect_pitch(PyObject *self, PyObject *args)
      Lower values of sens are more prone to octave skipping
      If values are too high can miss troughs altogether.
   */
-  cutoff = (int)(sens * ((float)(maxval - minval))) + minval;
+  cutoff = sens * (maxval - minval) + minval;
   /* Now find first value that is within the sensitivity range */
   o = min_period;
   while(o<=max_period && (amd[o] > cutoff)) o++;
@@ -114,23 +125,159 @@ static PyObject *detect_pitch(PyObject *self, PyObject *args)
       }
   }
 
-  Py_END_ALLOW_THREADS;
-
   /* How do we know whether we got a pitch or not?
      Compare amd at detected pitch with max amd.
      If maxval is ratio times bigger or more, we know we got a pitch.
   */
-  if((int)(amd[minpos] * ratio) < maxval) {
+  if(amd[minpos] * ratio < maxval) {
       // Got a pitch  
       free(amd);
-      return Py_BuildValue("i", minpos);
+      return minpos;
   }
   free(amd);
+  return 0;
+}
+
+/* Get samples from any object supporting the buffer protocol
+   NumPy int16 and float32 arrays, memoryviews and the like are used
+   in place without copying, the format says how to read them.  Byte
+   strings and objects with only the old buffer interface are taken
+   to hold 16-bit samples (analyse.py wraps array.array in a NumPy
+   array first so its typecode is kept).  Fills view, which
+   must be released with PyBuffer_Release, and sets kind and the
+   number of samples n.  Returns 0 on success or -1 with an exception
+   set.
+*/
+static int get_samples(PyObject *obj, Py_buffer *view, int *kind, int *n)
+{
+  const char *fmt;
+  const void *ptr;
+  Py_ssize_t len;
+
+  if (PyObject_CheckBuffer(obj)) {
+      if (PyObject_GetBuffer(obj, view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+          return -1;
+  } else {
+      if (PyObject_AsReadBuffer(obj, &ptr, &len) < 0)
+          return -1;
+      if (PyBuffer_FillInfo(view, obj, (void *)ptr, len, 1, PyBUF_SIMPLE) < 0)
+          return -1;
+  }
+  fmt = view->format;
+  if (fmt != NULL && (*fmt == '@' || *fmt == '=' || *fmt == '<'))
+      fmt++;
+  if (fmt == NULL || strcmp(fmt, "B") == 0 || strcmp(fmt, "b") == 0 ||
+      strcmp(fmt, "c") == 0 || strcmp(fmt, "h") == 0) {
+      *kind = SAMPLES_INT16;
+      *n = (int)(view->len / 2);
+  } else if (strcmp(fmt, "f") == 0) {
+      *kind = SAMPLES_FLOAT32;
+      *n = (int)(view->len / 4);
+  } else {
+      PyBuffer_Release(view);
+      PyErr_SetString(PyExc_TypeError, "samples must be int16 or float32");
+      return -1;
+  }
+  return 0;
+}
+
+static PyObject *detect_pitch(PyObject *self, PyObject *args)
+{
+  PyObject *obj;
+  Py_buffer view;
+  int kind, n;
+  float min_frequency, max_frequency, samplerate, sens, ratio;
+  int period;
+
+  if (!PyArg_ParseTuple(args, "Offfff", 
+                        &obj,
+                        &min_frequency, 
+                        &max_frequency, 
+                        &samplerate, 
+                        &sens,
+                        &ratio))
+      return NULL;
+  if (get_samples(obj, &view, &kind, &n) < 0)
+      return NULL;
+
+  Py_BEGIN_ALLOW_THREADS;
+  period = amdf_period(view.buf, kind, n,
+                       min_frequency, max_frequency,
+                       samplerate, sens, ratio);
+  Py_END_ALLOW_THREADS;
+
+  PyBuffer_Release(&view);
+  if(period < 0) return PyErr_NoMemory();
+  if(period > 0) return Py_BuildValue("i", period);
+  Py_RETURN_NONE;
+}
+
+static PyObject *detect_pitch_batch(PyObject *self, PyObject *args)
+{
+  PyObject *obj, *outobj;
+  Py_buffer view, outview;
+  int kind, n;
+  int size, hop, count;
+  float min_frequency, max_frequency, samplerate, sens, ratio;
+  int *periods;
+  int f, failed = 0;
+  const char *data;
+  int itemsize;
+
+  /* Arguments are the samples, frame size and hop in samples,
+     number of frames, detection parameters, and a writable buffer
+     of count C ints that receives the periods (0 for no pitch)
+  */
+  if (!PyArg_ParseTuple(args, "OiiifffffO", 
+                        &obj,
+                        &size, &hop, &count,
+                        &min_frequency, 
+                        &max_frequency, 
+                        &samplerate, 
+                        &sens,
+                        &ratio,
+                        &outobj))
+      return NULL;
+  if (get_samples(obj, &view, &kind, &n) < 0)
+      return NULL;
+  if (PyObject_GetBuffer(outobj, &outview, PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) < 0) {
+      PyBuffer_Release(&view);
+      return NULL;
+  }
+  if (size <= 0 || hop <= 0 || count < 0 ||
+      (count > 0 && (count - 1) * hop + size > n) ||
+      outview.len < count * (Py_ssize_t)sizeof(int)) {
+      PyBuffer_Release(&outview);
+      PyBuffer_Release(&view);
+      PyErr_SetString(PyExc_ValueError, "buffers too small for frames");
+      return NULL;
+  }
+  periods = (int *)outview.buf;
+  data = (const char *)view.buf;
+  itemsize = (kind == SAMPLES_INT16) ? 2 : 4;
+
+  /* One release of the GIL for all frames */
+  Py_BEGIN_ALLOW_THREADS;
+  for(f=0; f<count; f++) {
+      periods[f] = amdf_period(data + f * hop * itemsize, kind, size,
+                               min_frequency, max_frequency,
+                               samplerate, sens, ratio);
+      if(periods[f] < 0) {
+          failed = 1;
+          break;
+      }
+  }
+  Py_END_ALLOW_THREADS;
+
+  PyBuffer_Release(&outview);
+  PyBuffer_Release(&view);
+  if(failed) return PyErr_NoMemory();
   Py_RETURN_NONE;
 }
 
 PyMethodDef methods[] = {
     {"detect_pitch", detect_pitch, METH_VARARGS, "Detect fundamental pitch"},
+    {"detect_pitch_batch", detect_pitch_batch, METH_VARARGS, "Detect fundamental pitch of many frames"},
     {NULL, NULL, 0, NULL}
 };
 
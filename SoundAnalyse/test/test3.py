@@ -0,0 +1,27 @@
+import numpy
+import pyaudio
+import analyse
+
+# Initialize PyAudio
+pyaud = pyaudio.PyAudio()
+
+# Open input stream, 16-bit mono at 44100 Hz
+# On my system, device 1 is a USB microphone, your number may differ.
+stream = pyaud.open(
+    format = pyaudio.paInt16,
+    channels = 1,
+    rate = 44100,
+    input_device_index = 1,
+    input = True)
+
+# Small reads for low latency, long windows for low notes
+tracker = analyse.PitchTracker(window=2048, hop=256)
+
+while True:
+    # Read raw microphone data
+    rawsamps = stream.read(256)
+    # Convert raw data to NumPy array
+    samps = numpy.fromstring(rawsamps, dtype=numpy.int16)
+    # Show the time and pitch of each new estimate
+    for t, note in tracker.feed(samps):
+        print "%.3f" % t, note
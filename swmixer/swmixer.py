@@ -15,18 +15,35 @@ Released under the LGPL
 """
 
 
+import os
+import glob
+import math
 import time
 import wave
+import struct
+import hashlib
 import thread
+import threading
+import collections
 
 import numpy
-import pyaudio
+
+try:
+    import pyaudio
+except:
+    "Sound card output disabled, only null sinks available"
 
 try:
     import mad
 except:
     "MP3 streaming disabled"
 
+_SQRT2 = math.sqrt(2.0)
+
+# PortAudio callback flags, defined here so null sinks work without PyAudio
+_CONTINUE = 0 # paContinue
+_OUTPUT_UNDERFLOW = 4 # paOutputUnderflow
+
 ginit = False
 gstereo = True
 gchunksize = 1024
@@ -37,12 +54,33 @@ gpyaudio = None
 gstream = None
 gmicstream = None
 gmic = False
-gmicdata = None
+gmicring = numpy.zeros(0, numpy.int16)
+gmiccount = 0
+gmiclast = (0, 0)
+gmicstamps = collections.deque()
+gframes = 0
 gmixer_srcs = []
 gid = 1
 glock = thread.allocate_lock()
+gcommands = collections.deque()
 ginput_device_index = None
 goutput_device_index = None
+gmode = 'blocking'
+gresample_quality = 2
+gmax_voices = None
+glistener = (0.0, 0.0)
+grolloff = 1.0
+gref_distance = 1.0
+glimiter = None
+gsteal_policy = 'oldest'
+grendering = False
+gsink = None
+gwork = None
+gvols = None
+gpans = None
+goutbuf = None
+gbuses = {}
+gbus_order = []
 
 class _SoundSourceData:
     def __init__(self, data, loops):
@@ -50,95 +88,265 @@ class _SoundSourceData:
         self.pos = 0
         self.loops = loops
         self.done = False
+        # playback rate and fraction of a frame past pos
+        self.rate = 1.0
+        self.quality = 0
+        self.frac = 0.0
     def set_position(self, pos):
         self.pos = pos % len(self.data)
+        self.frac = 0.0
     def get_samples(self, sz):
-        z = self.data[self.pos:self.pos + sz]
-        self.pos += sz
-        if len(z) < sz:
-            # oops, sample data didn't cover buffer
-            if self.loops != 0:
-                # loop around
-                self.loops -= 1
-                self.pos = sz - len(z)
-                z = numpy.append(z, self.data[:sz - len(z)])
-            else:
-                # nothing to loop, just append zeroes
-                z = numpy.append(z, numpy.zeros(sz - len(z), numpy.int16))
-                # and stop the sample, it's done
-                self.done = True
-        if self.pos == len(self.data):
-            # this case loops without needing any appending
-            if self.loops != 0:
-                self.loops -= 1
-                self.pos = 0
-            else:
-                self.done = True
+        z = numpy.zeros(sz, self.data.dtype)
+        self.get_samples_into(z)
         return z
+    def _get_samples_rate(self, out):
+        # Read data at a fractional rate, interpolating on the fly
+        nf = len(self.data) // gchannels
+        m = len(out) // gchannels
+        start = self.pos // gchannels + self.frac
+        pos = start + self.rate * _sample_offsets(m)
+        end = start + self.rate * m
+        if self.loops >= 0 and end >= (self.loops + 1) * nf:
+            # not enough loops left to cover the chunk
+            k = int(numpy.searchsorted(pos, (self.loops + 1) * nf))
+            pos = pos[:k]
+            out[k * gchannels:] = 0
+            self.done = True
+        mode = 'wrap'
+        if self.loops == 0:
+            # don't interpolate last sample against the first one
+            mode = 'clip'
+        out2 = out.reshape(m, gchannels)
+        cutoff = min(1.0, 1.0 / self.rate)
+        if cutoff < 1.0:
+            # round down to steps of 1/32 so that sweeping the rate
+            # reuses a few kernel tables instead of making new ones
+            cutoff = max(1, int(cutoff * 32)) / 32.0
+        data = self.data.reshape(nf, gchannels)
+        out2[:len(pos)] = _interp_at(data, pos % nf, self.quality, cutoff, mode)
+        if self.done:
+            self.pos = len(self.data)
+            return
+        wraps = int(end // nf)
+        if self.loops > 0:
+            self.loops -= wraps
+        end -= wraps * nf
+        self.pos = int(end) * gchannels
+        self.frac = end - int(end)
+    def close(self):
+        None
+    def get_samples_into(self, out):
+        """Copy the next len(out) samples directly into out
+
+        Wraps around the end of the data as many times as the chunk
+        needs (and the loop count allows) without building any
+        intermediate arrays.  Once there is nothing left to loop the
+        rest of out is zeroed and the source is marked done.
+
+        """
+        if self.rate != 1.0 or self.frac != 0.0:
+            return self._get_samples_rate(out)
+        sz = len(out)
+        n = len(self.data)
+        i = 0
+        while i < sz:
+            k = min(sz - i, n - self.pos)
+            if k > 0:
+                out[i:i + k] = self.data[self.pos:self.pos + k]
+                i += k
+                self.pos += k
+            if self.pos >= n:
+                if self.loops != 0 and n > 0:
+                    # loop around
+                    self.loops -= 1
+                    self.pos = 0
+                else:
+                    # nothing to loop, fill with zeroes
+                    out[i:] = 0
+                    # and stop the sample, it's done
+                    self.done = True
+                    break
 
 class _SoundSourceStream:
-    def __init__(self, fileobj, loops):
+    """Stream source decoded ahead of time by its own thread
+
+    The decoder thread keeps a ring buffer of samples topped up, so
+    the mixer only ever copies samples out of the ring and a slow
+    decode never holds up the other channels.  If the ring runs dry
+    the missing samples are played as silence and counted.
+
+    """
+    def __init__(self, fileobj, loops, buffersize):
         self.fileobj = fileobj
         self.pos = 0
         self.loops = loops
         self.done = False
-        self.buf = ''
+        self.ring = numpy.zeros(buffersize, numpy.int16)
+        # Total samples ever read (only the mixer changes this) and
+        # written (only the decoder changes this), wrapped into the ring
+        self.rcount = 0
+        self.wcount = 0
+        # write counts where the decoder looped back to the start
+        self.loopmarks = collections.deque()
+        self.eof = False
+        self.seek_to = None
+        # guards seek_to, so a seek requested while the decoder is
+        # seeking is not cleared along with the one it finished
+        self.seeklock = threading.Lock()
+        self.underruns = 0
+        self.underrun_samples = 0
+        self.running = True
+        # wakeup is set by the mixer when it frees space or needs a
+        # seek, filled is set by the decoder when it adds samples
+        self.wakeup = threading.Event()
+        self.filled = threading.Event()
+        thread.start_new_thread(self._decode, ())
     def set_position(self, pos):
+        # The decoder does the seek, until then the ring counts as empty
+        self.seeklock.acquire()
         self.pos = pos
-        self.fileobj.seek_time(pos * 1000 / gsamplerate / 2)
-    def get_samples(self, sz):
-        szb = sz * 2
-        while len(self.buf) < szb:
-            s = self.fileobj.read()
-            if s is None or s == '': break
-            self.buf += s[:]
-        z = numpy.fromstring(self.buf[:szb], dtype=numpy.int16)
-        if len(z) < sz:
-            # In this case we ran out of stream data
-            # append zeros (don't try to be sample accurate for streams)
-            z = numpy.append(z, numpy.zeros(sz - len(z), numpy.int16))
-            if self.loops != 0:
-                self.loops -= 1
-                self.pos = 0
-                self.fileobj.seek_time(0)
-                self.buf = ''
-            else:
-                self.done = True
+        self.seek_to = pos
+        self.seeklock.release()
+        self.wakeup.set()
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.filled.set()
+    def _seek(self, pos):
+        if hasattr(self.fileobj, 'seek_sample'):
+            # sample accurate (WAV)
+            self.fileobj.seek_sample(pos)
         else:
-            # remove head of buffer
-            self.buf = self.buf[szb:]
+            self.fileobj.seek_time(pos * 1000 / gsamplerate / 2)
+    def _decode(self):
+        # Decoder thread, fills the ring until the stream is closed
+        pending = None
+        while self.running:
+            to = self.seek_to
+            if to is not None:
+                self._seek(to)
+                pending = None
+                self.eof = False
+                self.loopmarks.clear()
+                # mixer does not touch rcount while a seek is pending
+                self.rcount = self.wcount
+                self.seeklock.acquire()
+                if self.seek_to is to:
+                    self.seek_to = None
+                self.seeklock.release()
+            if pending is None or len(pending) == 0:
+                if self.eof:
+                    self.filled.set()
+                    self.wakeup.clear()
+                    if self.running and self.seek_to is None:
+                        self.wakeup.wait()
+                    continue
+                s = self.fileobj.read()
+                if s is None or len(s) == 0:
+                    if self.loops != 0:
+                        # loop without a gap
+                        self.loops -= 1
+                        self._seek(0)
+                        self.loopmarks.append(self.wcount)
+                    else:
+                        self.eof = True
+                    continue
+                pending = numpy.frombuffer(s, dtype=numpy.int16)
+            self.wakeup.clear()
+            space = len(self.ring) - (self.wcount - self.rcount)
+            if space == 0:
+                if self.running and self.seek_to is None:
+                    self.wakeup.wait()
+                continue
+            n = min(space, len(pending))
+            self._ring_copy(pending[:n], self.wcount)
+            pending = pending[n:]
+            self.wcount += n
+            self.filled.set()
+    def _ring_copy(self, data, count):
+        # copy data into ring at total count, wrapping around the end
+        i = count % len(self.ring)
+        k = min(len(data), len(self.ring) - i)
+        self.ring[i:i + k] = data[:k]
+        self.ring[:len(data) - k] = data[k:]
+    def get_samples(self, sz):
+        z = numpy.zeros(sz, numpy.int16)
+        self.get_samples_into(z)
         return z
+    def _wait_filled(self, sz):
+        # Offline rendering waits for the decoder instead of skipping
+        while self.running and not self.eof and \
+                (self.seek_to is not None or self.wcount - self.rcount < sz):
+            self.filled.clear()
+            if self.running and not self.eof and \
+                    (self.seek_to is not None or self.wcount - self.rcount < sz):
+                self.filled.wait()
+    def get_samples_into(self, out):
+        sz = len(out)
+        if grendering:
+            self._wait_filled(sz)
+        if self.seek_to is not None:
+            out[:] = 0
+            return
+        n = min(sz, self.wcount - self.rcount)
+        i = self.rcount % len(self.ring)
+        k = min(n, len(self.ring) - i)
+        out[:k] = self.ring[i:i + k]
+        out[k:n] = self.ring[:n - k]
+        self.rcount += n
+        self.pos += n
+        while len(self.loopmarks) > 0 and self.loopmarks[0] <= self.rcount:
+            self.pos = self.rcount - self.loopmarks.popleft()
+        if n < sz:
+            out[n:] = 0
+            if self.eof and self.wcount == self.rcount:
+                self.done = True
+                self.close()
+            else:
+                # decoder fell behind
+                self.underruns += 1
+                self.underrun_samples += sz - n
+        self.wakeup.set()
 
 # A channel is a "sound event" that is playing
 class Channel:
     """Represents one sound source currently playing"""
-    def __init__(self, src, env):
+    def __init__(self, src, env, sound=None, priority=0, bus='master'):
         global gid
         self.id = gid
         gid += 1
+        self.bus = gbuses[bus]
+        self.sound = sound
+        self.priority = priority
+        self.pan = 0.0
+        self.location = None
         self.src = src
-        self.env = env
+        # output frame to start on, see get_clock()
+        self.start = None
+        self._set_env(env)
         self.active = True
         self.done = False
+        self._publish()
+    def _set_env(self, env):
+        # Compile envelope into sorted breakpoint arrays for numpy.interp
+        self.env = env
+        if len(env) == 0:
+            env = [[0, 1.0]]
+        e = numpy.array(env, dtype=numpy.float64).reshape(-1, 2)
+        e = e[numpy.argsort(e[:, 0], kind='mergesort')]
+        self.env_t = e[:, 0].copy()
+        self.env_v = e[:, 1].copy()
+        # number of breakpoints at or before current position
+        self.env_cursor = 0
     def stop(self):
         """Stop the sound playing"""
-        glock.acquire()
-        # If the sound has already ended, don't raise exception
-        try:
-            gmixer_srcs.remove(self)
-        except ValueError:
-            None
-        glock.release()
+        _command(self._stop)
     def pause(self):
         """Pause the sound temporarily"""
-        glock.acquire()
-        self.active = False
-        glock.release()
+        _command(self._set_active, False)
     def unpause(self):
         """Unpause a previously paused sound"""
-        glock.acquire()
-        self.active = True
-        glock.release()
+        _command(self._set_active, True)
     def set_volume(self, v, fadetime=0):
         """Set the volume of the sound
 
@@ -146,70 +354,394 @@ class Channel:
         overrides any pending fadeins or fadeouts.
 
         """
-        glock.acquire()
-        if fadetime == 0:
-            self.env = [[0, v]]
-        else:
-            curv = calc_vol(self.src.pos, self.env)
-            self.env = [[self.src.pos, curv], [self.src.pos + fadetime, v]]
-        glock.release()
+        _command(self._set_volume, v, fadetime)
     def get_volume(self):
-        """Return current volume of sound"""
-        glock.acquire()
-        v = calc_vol(self.src.pos, self.env)
-        glock.release()
-        return v
+        """Return current volume of sound
+
+        The value is the one published by the mixer after the most
+        recent chunk, so changes requested since then are not yet
+        visible.
+
+        """
+        return self.snapshot[1]
     def get_position(self):
-        """Return current position of sound in samples"""
-        glock.acquire()
-        p = self.src.pos
-        glock.release()
-        return p
+        """Return current position of sound in samples
+
+        The value is the one published by the mixer after the most
+        recent chunk, so changes requested since then are not yet
+        visible.
+
+        """
+        return self.snapshot[0]
     def set_position(self, p):
         """Set current position of sound in samples"""
-        glock.acquire()
-        self.src.set_position(p)
-        glock.release()
+        _command(self._set_position, p)
     def fadeout(self, time):
         """Schedule a fadeout of this sound in given time"""
-        glock.acquire()
         self.set_volume(0.0, fadetime=time)
-        glock.release()
-    def _get_samples(self, sz):
-        if not self.active: return None
-        v = calc_vol(self.src.pos, self.env)
-        z = self.src.get_samples(sz)
+    def get_stream_stats(self):
+        """Return buffering statistics of a StreamingSound channel
+
+        Returns a dictionary with the number of chunks where the
+        decoder fell behind ('underruns'), the samples of silence that
+        were played because of it ('underrun_samples') and the samples
+        currently decoded ahead ('buffered').  Returns None for
+        channels playing regular Sounds.
+
+        """
+        if not isinstance(self.src, _SoundSourceStream):
+            return None
+        return {'underruns': self.src.underruns,
+                'underrun_samples': self.src.underrun_samples,
+                'buffered': self.src.wcount - self.src.rcount}
+    def set_pan(self, pan):
+        """Set stereo position of the sound
+
+        pan goes from -1.0 (left) through 0.0 (center) to 1.0
+        (right).  Uses an equal power law, so the sound keeps the same
+        loudness as it moves.  Has no effect in mono output.
+
+        """
+        _command(self._set_pan, pan)
+    def set_location(self, x, y=0.0):
+        """Place the sound at a point in the game world
+
+        The sound is panned by its direction from the listener and
+        gets quieter with distance, see set_listener() and
+        set_rolloff().  Overrides set_pan().  Call set_location(None)
+        to go back to plain panning.
+
+        """
+        if x is None:
+            _command(self._set_location, None)
+        else:
+            _command(self._set_location, (x, y))
+    def set_bus(self, name):
+        """Move the sound to the named bus"""
+        _command(self._set_bus, gbuses[name])
+    def set_rate(self, rate, quality=0):
+        """Set playback rate of the sound
+
+        The sample data is read at the given rate and interpolated
+        while mixing, so the sound plays faster and higher (rate 2.0
+        is up an octave) or slower and lower (rate 0.5 is down an
+        octave) without making a resampled copy.  Any number of
+        channels can play the same Sound at different rates.  Only
+        available for Sounds, not StreamingSounds.
+
+        quality is the same as for the resample() function, higher
+        qualities cost more to mix.
+
+        """
+        assert(rate > 0)
+        # streams are decoded at their own pace, rate is not supported
+        assert(isinstance(self.src, _SoundSourceData))
+        _command(self._set_rate, rate, quality)
+    # The following methods run in the mixer at the start of a chunk
+    def _stop(self):
+        self.src.close()
+        # If the sound has already ended, don't raise exception
+        try:
+            gmixer_srcs.remove(self)
+        except ValueError:
+            None
+    def _set_active(self, active):
+        self.active = active
+    def _set_volume(self, v, fadetime):
+        if fadetime == 0:
+            self._set_env([[0, v]])
+        else:
+            pos = self.src.pos
+            curv = self._calc_vol(pos)
+            self._set_env([[pos, curv], [pos + fadetime, v]])
+        self._publish()
+    def _set_pan(self, pan):
+        self.pan = max(-1.0, min(1.0, pan))
+    def _set_location(self, location):
+        self.location = location
+    def _placement(self):
+        # Return (distance attenuation, pan)
+        if self.location is None:
+            return 1.0, self.pan
+        dx = self.location[0] - glistener[0]
+        dy = self.location[1] - glistener[1]
+        d = math.hypot(dx, dy)
+        gain = 1.0
+        if d > gref_distance:
+            gain = gref_distance / (gref_distance + grolloff * (d - gref_distance))
+        return gain, max(-1.0, min(1.0, dx / max(d, gref_distance)))
+    def _pan_gains(self):
+        # Left and right gains, both 1.0 in the center
+        gain, pan = self._placement()
+        a = (pan + 1.0) * math.pi / 4.0
+        return gain * _SQRT2 * math.cos(a), gain * _SQRT2 * math.sin(a)
+    def _set_bus(self, bus):
+        self.bus = bus
+    def _set_rate(self, rate, quality):
+        self.src.rate = rate
+        self.src.quality = quality
+    def _set_position(self, p):
+        self.src.set_position(p)
+        self._publish()
+    def _publish(self):
+        # Snapshot read by get_position() and get_volume()
+        # A tuple is replaced in one step so readers never need a lock
+        self.snapshot = (self.src.pos, self._calc_vol(self.src.pos))
+    def _calc_vol(self, t):
+        # Same result as calc_vol(t, self.env) using binary search
+        return float(numpy.interp(t, self.env_t, self.env_v))
+    def _env_chunk(self, pos, sz, rate=1.0):
+        """Return volume over samples pos..pos+sz-1
+
+        With a playback rate the source moves rate samples per output
+        sample, so the envelope is read at pos + rate * i instead.
+
+        Returns a single float when the envelope is flat over the
+        whole chunk, otherwise an array with one volume per sample.
+        The breakpoint cursor is cached between chunks so steady
+        playback never searches the envelope.
+
+        """
+        t, v = self.env_t, self.env_v
+        k = self.env_cursor
+        if (k > 0 and t[k - 1] > pos) or (k < len(t) and t[k] <= pos):
+            # cursor is stale (seek or new envelope), binary search
+            k = int(numpy.searchsorted(t, pos, side='right'))
+            self.env_cursor = k
+        if k == len(t):
+            # envelope is over, use last volume
+            return v[-1]
+        if pos + rate * (sz - 1) < t[k]:
+            # whole chunk is before breakpoint k
+            if k == 0:
+                return v[0]
+            if v[k - 1] == v[k]:
+                return v[k]
+        if rate == 1.0:
+            return numpy.interp(pos + _sample_offsets(sz), t, v)
+        return numpy.interp(pos + rate * _sample_offsets(sz), t, v)
+    def _get_samples(self, out):
+        # Copy next chunk of samples into out, return volume to mix at
+        rate = getattr(self.src, 'rate', 1.0)
+        if rate == 1.0:
+            v = self._env_chunk(self.src.pos, len(out))
+        else:
+            # envelope follows the source positions actually read
+            pos = self.src.pos + self.src.frac * gchannels
+            v = self._env_chunk(pos, len(out), rate)
+        self.src.get_samples_into(out)
         if self.src.done: self.done = True
-        return z * v
+        if isinstance(v, numpy.ndarray):
+            # volume changes during chunk, apply it per sample
+            out *= v
+            self.snapshot = (self.src.pos, v[-1])
+            return 1.0
+        self.snapshot = (self.src.pos, v)
+        return v
+
+
+
+class Bus:
+    """A group of channels that is mixed together
 
+    Every channel plays on a bus, and every bus except 'master' is
+    mixed into a parent bus.  Changing the volume of a bus or muting
+    it affects all channels on it at once, and effects added to a bus
+    run once per chunk on the mix of all its channels.  By default
+    there is a 'master' bus which is the output, and 'music', 'sfx'
+    and 'voice' buses that feed it.  See add_bus() and get_bus().
+
+    """
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.volume = 1.0
+        self.muted = False
+        self.effects = []
+        self.voices = []
+        self.buf = None
+    def set_volume(self, v):
+        """Set the volume of everything playing on this bus"""
+        self.volume = v
+    def get_volume(self):
+        """Return the volume of this bus"""
+        return self.volume
+    def mute(self):
+        """Silence this bus, its channels keep playing"""
+        self.muted = True
+    def unmute(self):
+        """Undo a previous mute()"""
+        self.muted = False
+    def add_effect(self, f):
+        """Add an effect to this bus
+
+        f is called as f(buf) once per chunk with a float Numpy array
+        holding the mix of this bus, and must change it in place.
+        Effects run in the order they were added.
+
+        """
+        # replace list in one step, the mixer may be reading it
+        self.effects = self.effects + [f]
+    def remove_effect(self, f):
+        """Remove an effect added with add_effect()"""
+        self.effects = [e for e in self.effects if e is not f]
+
+def set_listener(x, y=0.0):
+    """Set where the listener is in the game world
+
+    Channels placed with Channel.set_location() are panned and
+    attenuated relative to this point.
+
+    """
+    global glistener
+    glistener = (x, y)
 
+def set_rolloff(rolloff=1.0, ref_distance=1.0):
+    """Set how located sounds get quieter with distance
 
-def resample(smp, scale=1.0):
+    Sounds within ref_distance of the listener play at full volume.
+    Further away the volume is ref_distance / (ref_distance +
+    rolloff * (distance - ref_distance)), so higher rolloff makes
+    sounds fade faster.  A rolloff of 0.0 turns attenuation off.
+
+    """
+    global grolloff, gref_distance
+    grolloff = rolloff
+    gref_distance = ref_distance
+
+def add_bus(name, parent='master'):
+    """Create a new bus feeding into the named parent bus
+
+    Returns the new Bus.  Channels play on it by passing its name as
+    the bus keyword to play().
+
+    """
+    global gbus_order
+    assert(name not in gbuses)
+    if parent is not None:
+        parent = gbuses[parent]
+    bus = Bus(name, parent)
+    gbuses[name] = bus
+    def depth(b):
+        d = 0
+        while b.parent is not None:
+            b = b.parent
+            d += 1
+        return d
+    # deepest buses first, so children are mixed before parents
+    # the mixer picks up the new list in one step
+    gbus_order = sorted(gbus_order + [bus], key=depth, reverse=True)
+    return bus
+
+def get_bus(name):
+    """Return the Bus with the given name"""
+    return gbuses[name]
+
+add_bus('master', None)
+add_bus('music')
+add_bus('sfx')
+add_bus('voice')
+
+goffsets = numpy.arange(0, dtype=numpy.float64)
+
+def _sample_offsets(sz):
+    """Return a cached array [0, 1, ..., sz-1] of floats"""
+    global goffsets
+    if len(goffsets) < sz:
+        goffsets = numpy.arange(sz, dtype=numpy.float64)
+    return goffsets[:sz]
+
+# Half width in taps of the windowed sinc kernel for each quality level
+_SINC_HALFWIDTH = {1: 4, 2: 8, 3: 16}
+# Kernel positions tabulated between two input samples
+_SINC_PHASES = 256
+# Output frames resampled at once, bounds temporary memory
+_RESAMPLE_BLOCK = 4096
+
+gsinc_tables = {}
+
+def _sinc_table(quality, cutoff):
+    """Return tabulated windowed sinc kernel for quality and cutoff
+
+    cutoff is the passband as a fraction of the input Nyquist
+    frequency, below 1.0 when the output has a lower rate so the
+    kernel also filters out frequencies that would alias.  Returns
+    (table, offsets) where row p of table holds tap weights for a
+    position p / _SINC_PHASES past an input sample, and offsets holds
+    the tap positions relative to that input sample.
+
+    """
+    key = (quality, cutoff)
+    if key not in gsinc_tables:
+        # widen the kernel as the cutoff drops to keep same quality
+        hw = int(numpy.ceil(_SINC_HALFWIDTH[quality] / cutoff))
+        offsets = numpy.arange(1 - hw, hw + 1)
+        frac = numpy.arange(_SINC_PHASES + 1) * 1.0 / _SINC_PHASES
+        x = offsets[numpy.newaxis, :] - frac[:, numpy.newaxis]
+        # Blackman window over the kernel width
+        wx = numpy.pi * x / hw
+        win = 0.42 + 0.5 * numpy.cos(wx) + 0.08 * numpy.cos(2.0 * wx)
+        table = cutoff * numpy.sinc(cutoff * x) * win
+        # normalize so every phase passes DC unchanged
+        table /= table.sum(axis=1)[:, numpy.newaxis]
+        gsinc_tables[key] = (table, offsets)
+    return gsinc_tables[key]
+
+def _interp_at(data, pos, quality=0, cutoff=1.0, mode='clip'):
+    """Return samples of data at fractional frame positions pos
+
+    data is a 2D array of frames by channels, all channels are
+    interpolated in one pass.  quality 0 is linear interpolation,
+    1-3 use windowed sinc kernels of increasing length.  mode says
+    how to treat positions past either end of data: 'clip' repeats
+    the edge samples, 'wrap' reads around the other end (for loops).
+
+    """
+    i = numpy.floor(pos).astype(numpy.intp)
+    f = pos - i
+    if quality == 0:
+        a = data.take(i, axis=0, mode=mode)
+        b = data.take(i + 1, axis=0, mode=mode)
+        f = f[:, numpy.newaxis]
+        return a * (1.0 - f) + b * f
+    table, offsets = _sinc_table(quality, cutoff)
+    w = table[(f * _SINC_PHASES + 0.5).astype(numpy.intp)]
+    taps = data.take(i[:, numpy.newaxis] + offsets, axis=0, mode=mode)
+    return numpy.einsum('nt,ntc->nc', w, taps)
+
+def resample(smp, scale=1.0, quality=0, channels=1):
     """Resample a sound to be a different length
 
-    Sample must be mono.  May take some time for longer sounds
-    sampled at 44100 Hz.
+    Works in blocks, so memory use does not grow with the length of
+    the sound.  Returns a new array of floats.
 
     Keyword arguments:
     scale - scale factor for length of sound (2.0 means double length)
+    quality - 0 for linear interpolation (fastest), 1, 2 or 3 for
+      band-limited windowed sinc interpolation of increasing quality
+      that avoids aliasing (default 0)
+    channels - number of interleaved channels in smp (default 1)
 
     """
-    # f*ing cool, numpy can do this with one command
     # calculate new length of sample
-    n = round(len(smp) * scale)
-    # use linear interpolation
-    # endpoint keyword means than linspace doesn't go all the way to 1.0
-    # If it did, there are some off-by-one errors
+    nin = len(smp) // channels
+    n = int(round(nin * scale))
+    # Output frame k is at input position k * nin / n
+    # This matches linspace(0, 1, endpoint=False) on both sides
     # e.g. scale=2.0, [1,2,3] should go to [1,1.5,2,2.5,3,3]
-    # but with endpoint=True, we get [1,1.4,1.8,2.2,2.6,3]
-    # Both are OK, but since resampling will often involve
+    # Since resampling will often involve
     # exact ratios (i.e. for 44100 to 22050 or vice versa)
-    # using endpoint=False gets less noise in the resampled sound
-    return numpy.interp(
-        numpy.linspace(0.0, 1.0, n, endpoint=False), # where to interpret
-        numpy.linspace(0.0, 1.0, len(smp), endpoint=False), # known positions
-        smp, # known data points
-        )
+    # this gets less noise in the resampled sound
+    step = nin * 1.0 / max(n, 1)
+    # shrinking means lowering the rate, filter above new Nyquist
+    cutoff = min(1.0, n * 1.0 / max(nin, 1))
+    data = numpy.asarray(smp).reshape(-1, channels)
+    out = numpy.empty((n, channels), numpy.float64)
+    for start in xrange(0, n, _RESAMPLE_BLOCK):
+        stop = min(n, start + _RESAMPLE_BLOCK)
+        pos = numpy.arange(start, stop) * step
+        out[start:stop] = _interp_at(data, pos, quality, cutoff)
+    return out.reshape(-1)
 
 def interleave(left, right):
     """Given two separate arrays, return a new interleaved array
@@ -241,11 +773,204 @@ def stereo_to_mono(left, right):
     return (0.5 * left + 0.5 * right).astype(numpy.int16)
 
 
+def _wav_info(filename):
+    """Read the header of a PCM WAV file without loading any samples
+
+    Returns a tuple (channels, sample width in bytes, framerate,
+    number of frames, byte offset of the first frame in the file), or
+    None if the file is not a plain PCM WAV file.
+
+    """
+    f = open(filename, 'rb')
+    try:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != 'RIFF' or riff[8:12] != 'WAVE':
+            return None
+        fmt = None
+        while True:
+            hdr = f.read(8)
+            if len(hdr) < 8:
+                return None
+            cid, size = struct.unpack('<4sI', hdr)
+            if cid == 'fmt ':
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                # chunks are padded to an even number of bytes
+                f.seek(size - 16 + (size & 1), 1)
+            elif cid == 'data':
+                if fmt is None or fmt[0] != 1:
+                    return None # compressed or extensible format
+                nc, fr, sw = fmt[1], fmt[2], fmt[5] // 8
+                offset = f.tell()
+                # some writers leave the size unset, trust the file size
+                size = min(size, os.path.getsize(filename) - offset)
+                return nc, sw, fr, size // (nc * sw), offset
+            else:
+                f.seek(size + (size & 1), 1)
+    finally:
+        f.close()
+
+def _decode_file(filename):
+    """Load a WAV or MP3 file and convert it to the output format
+
+    Returns the sample data and the original framerate of the file.
+
+    """
+    smp = None
+    # Load data from file into smp
+    # Here's how to do it for WAV
+    # (Both of the loaders set nc to channels and fr to framerate
+    if filename[-3:] in ['wav','WAV']:
+        info = _wav_info(filename)
+        if info is not None and info[:3] == (gchannels, 2, gsamplerate):
+            # Already in output format, map the data chunk straight
+            # from the file instead of reading and copying it
+            nc, sw, fr, nframes, offset = info
+            smp = numpy.memmap(filename, dtype='<i2', mode='r',
+                               offset=offset, shape=(nframes * nc,))
+            return smp, fr
+        wf = wave.open(filename, 'rb')
+        #assert(wf.getsampwidth() == 2)
+        nc = wf.getnchannels()
+        framerate = wf.getframerate()
+        fr = wf.getframerate()
+        # read data in one piece, frombuffer does not copy it again
+        nframes = wf.getnframes()
+        if info is not None:
+            # header sizes can be wrong, this one is checked against file
+            nframes = info[3]
+        data = wf.readframes(nframes)
+        if wf.getsampwidth() == 2:
+            smp = numpy.frombuffer(data, dtype=numpy.int16)
+        if wf.getsampwidth() == 4: 
+            smp = numpy.frombuffer(data, dtype=numpy.int32)
+            smp = smp / 65536.0
+        if wf.getsampwidth() == 1:
+            smp = numpy.frombuffer(data, dtype=numpy.uint8)
+            smp = smp * 256.0
+        wf.close()
+    # Here's how to do it for MP3
+    if filename[-3:] in ['mp3','MP3']:
+        mf = mad.MadFile(filename)
+        # HACK ALERT
+        # Looks like MAD always gives us stereo
+        ##nc = mf.mode()
+        ##if nc == 0: nc = 1
+        nc = 2
+        framerate = mf.samplerate()
+        fr = mf.samplerate()
+        # read data
+        data = []
+        while True:
+            r = mf.read()
+            if r is None: break
+            data.append(r[:])
+        smp = numpy.fromstring(''.join(data), dtype=numpy.int16)
+        del(mf)
+    if smp is None:
+        assert False
+    # Resample if needed
+    if fr != gsamplerate:
+        scale = gsamplerate * 1.0 / fr
+        # both channels of stereo are done in one pass
+        smp = resample(smp, scale, quality=gresample_quality, channels=nc)
+    # Stereo convert if necessary
+    if nc != gchannels:
+        # oops, stereo-ness differs
+        # convert to match init parameters
+        if nc == 1:
+            # came in mono, need stereo
+            smp = interleave(smp, smp)
+        if nc == 2:
+            # came in stereo, need mono
+            # first make it a 2d array
+            left, right = uninterleave(smp)
+            smp = stereo_to_mono(left, right)
+    return smp, framerate
+
+gcache = collections.OrderedDict()
+gcache_bytes = 0
+gcache_budget = 64 * 1024 * 1024
+gcache_dir = None
+
+def set_cache(budget=64 * 1024 * 1024, directory=None):
+    """Configure the cache of decoded sounds
+
+    Sounds loaded from files are decoded, resampled and stereo
+    converted once and then shared by every Sound made from the same
+    file, as long as the file has not changed and the output format is
+    the same.  Least recently used entries are dropped when the cache
+    grows beyond its budget.
+
+    Keyword arguments:
+    budget - maximum bytes of decoded sample data to keep in memory
+      (default 64 MB, 0 disables the memory cache)
+    directory - if given, decoded data is also saved there as .npy
+      files, and later loads (even by other processes) memory map
+      them instead of decoding again (default None)
+
+    """
+    global gcache_budget, gcache_dir
+    gcache_budget = budget
+    gcache_dir = directory
+    if directory is not None and not os.path.isdir(directory):
+        os.makedirs(directory)
+    _trim_cache()
+
+def clear_cache():
+    """Drop all decoded sounds from the memory cache"""
+    global gcache_bytes
+    gcache.clear()
+    gcache_bytes = 0
+
+def _trim_cache():
+    global gcache_bytes
+    while gcache_bytes > gcache_budget and len(gcache) > 0:
+        key, (smp, framerate) = gcache.popitem(last=False)
+        gcache_bytes -= smp.nbytes
+
+def _cached_decode(filename):
+    """Same as _decode_file() but shares results through the cache"""
+    global gcache_bytes
+    key = (os.path.abspath(filename), os.path.getmtime(filename),
+           gsamplerate, gchannels, gresample_quality)
+    if key in gcache:
+        # move to most recently used end
+        smp, framerate = gcache.pop(key)
+        gcache[key] = (smp, framerate)
+        return smp, framerate
+    smp = None
+    if gcache_dir is not None:
+        # framerate of the original file is part of the cache filename
+        h = hashlib.md5(repr(key)).hexdigest()
+        found = glob.glob(os.path.join(gcache_dir, h + '_*.npy'))
+        if found:
+            framerate = int(found[0][:-4].split('_')[-1])
+            smp = numpy.load(found[0], mmap_mode='r')
+    if smp is None:
+        smp, framerate = _decode_file(filename)
+        if gcache_dir is not None:
+            numpy.save(os.path.join(gcache_dir, '%s_%d.npy' % (h, framerate)),
+                       smp)
+    # shared between Sounds, so nobody may change it in place
+    smp.setflags(write=False)
+    if smp.nbytes <= gcache_budget:
+        gcache[key] = (smp, framerate)
+        gcache_bytes += smp.nbytes
+        _trim_cache()
+    return smp, framerate
+
 class Sound:
     """Represents a playable sound"""
 
-    def __init__(self, filename=None, data=None):
-        """Create new sound from a WAV file, MP3 file, or explicit sample data"""
+    max_instances = None
+
+    def __init__(self, filename=None, data=None, cache=True):
+        """Create new sound from a WAV file, MP3 file, or explicit sample data
+
+        Decoded files are shared through a cache, see set_cache().
+        Pass cache=False to always decode the file again.
+
+        """
         assert(ginit == True)
         # Three ways to construct Sound
         # First is by passing data directly
@@ -255,78 +980,10 @@ class Sound:
         if filename is None:
             assert False
         # Second is through a file
-        self.data = None
-        # Load data from file into self.data
-        # Here's how to do it for WAV
-        # (Both of the loaders set nc to channels and fr to framerate
-        if filename[-3:] in ['wav','WAV']:
-            wf = wave.open(filename, 'rb')
-            #assert(wf.getsampwidth() == 2)
-            nc = wf.getnchannels()
-            self.framerate = wf.getframerate()
-            fr = wf.getframerate()
-            # read data
-            data = []
-            r = ' '
-            while r != '':
-                r = wf.readframes(4096)
-                data.append(r)
-            if wf.getsampwidth() == 2:
-                self.data = numpy.fromstring(''.join(data), 
-                                             dtype=numpy.int16)
-            if wf.getsampwidth() == 4: 
-                self.data = numpy.fromstring(''.join(data), 
-                                             dtype=numpy.int32)
-                self.data = self.data / 65536.0
-            if wf.getsampwidth() == 1:
-                self.data = numpy.fromstring(''.join(data), 
-                                             dtype=numpy.uint8)
-                self.data = self.data * 256.0
-            wf.close()
-        # Here's how to do it for MP3
-        if filename[-3:] in ['mp3','MP3']:
-            mf = mad.MadFile(filename)
-            # HACK ALERT
-            # Looks like MAD always gives us stereo
-            ##nc = mf.mode()
-            ##if nc == 0: nc = 1
-            nc = 2
-            self.framerate = mf.samplerate()
-            fr = mf.samplerate()
-            # read data
-            data = []
-            while True:
-                r = mf.read()
-                if r is None: break
-                data.append(r[:])
-            self.data = numpy.fromstring(''.join(data), dtype=numpy.int16)
-            del(mf)
-        if self.data is None:
-            assert False
-        # Resample if needed
-        if fr != gsamplerate:
-            scale = gsamplerate * 1.0 / fr
-            if nc == 1:
-                self.data = resample(self.data, scale)
-            if nc == 2:
-                # for stereo resample independently
-                left, right = uninterleave(self.data)
-                nleft = resample(left, scale)
-                nright = resample(right, scale)
-                self.data = interleave(nleft, nright)
-        # Stereo convert if necessary
-        if nc != gchannels:
-            # oops, stereo-ness differs
-            # convert to match init parameters
-            if nc == 1:
-                # came in mono, need stereo
-                self.data = interleave(self.data, self.data)
-            if nc == 2:
-                # came in stereo, need mono
-                # first make it a 2d array
-                left, right = uninterleave(self.data)
-                self.data = stereo_to_mono(left, right)
-        return
+        if cache:
+            self.data, self.framerate = _cached_decode(filename)
+        else:
+            self.data, self.framerate = _decode_file(filename)
 
     def get_length(self):
         """Return the length of the sound in samples
@@ -337,7 +994,7 @@ class Sound:
         """
         return len(self.data)
 
-    def play(self, volume=1.0, offset=0, fadein=0, envelope=None, loops=0):
+    def play(self, volume=1.0, offset=0, fadein=0, envelope=None, loops=0, rate=1.0, priority=0, bus='master', pan=0.0, at_sample=None):
         """Play the sound
 
         Keyword arguments:
@@ -347,6 +1004,19 @@ class Sound:
         envelope - a list of [offset, volume] pairs defining
                    a linear volume envelope
         loops - how many times to play the sound (-1 is infinite)
+        rate - playback rate, see Channel.set_rate() (default 1.0)
+        priority - when voices are limited, a sound can only take the
+                   voice of one with the same or lower priority
+                   (default 0), see set_max_voices()
+        bus - name of the bus to play on (default 'master'), see Bus
+        pan - stereo position from -1.0 (left) to 1.0 (right),
+              see Channel.set_pan() (default 0.0)
+        at_sample - frame to start on, on the clock returned by
+                    get_clock().  The sound is mixed in exactly there,
+                    even in the middle of a chunk, and heard
+                    get_latency() later like every other mixed
+                    frame.  None or a frame already mixed starts with
+                    the next chunk (default)
 
         """
         if envelope != None:
@@ -361,12 +1031,23 @@ class Sound:
                     env = [[offset, 0.0], [offset + fadein, volume]]
         src = _SoundSourceData(self.data, loops)
         src.pos = offset
-        sndevent = Channel(src, env)
-        glock.acquire()
-        gmixer_srcs.append(sndevent)
-        glock.release()
+        src.rate = rate
+        sndevent = Channel(src, env, self, priority, bus)
+        sndevent.pan = max(-1.0, min(1.0, pan))
+        sndevent.start = at_sample
+        _command(_start_channel, sndevent)
         return sndevent
 
+    def set_max_instances(self, n=None):
+        """Limit how many channels can play this sound at once
+
+        When the limit is reached, playing the sound again steals the
+        voice of one of its own channels following the policy set by
+        set_max_voices().  None means no limit (default).
+
+        """
+        self.max_instances = n
+
     def scale(self, vol):
         """Scale a sound sample
 
@@ -374,37 +1055,67 @@ class Sound:
         """
         self.data = (self.data * vol).astype(numpy.int16)
 
-    def resample(self, scale):
+    def resample(self, scale, quality=0):
          """Resample a sound
 
          scale = 1.0 means original sound
          scale = 0.5 is half as long (up an octave)
          scale = 2.0 is twice as long (down an octave)
+
+         quality is the same as for the resample() function.
          
          """
-         self.data = resample(self.data, scale)
+         self.data = resample(self.data, scale, quality, gchannels)
+
+gwav_headers = {}
 
-class _Stream:
-    pass
+def _cached_wav_info(filename):
+    """Same as _wav_info() but remembers headers of unchanged files"""
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    if key not in gwav_headers:
+        gwav_headers[key] = _wav_info(filename)
+    return gwav_headers[key]
+
+class _WavStream:
+    """Reads PCM data of a WAV file in pieces for streaming
+
+    Has the same read(), seek_time() and total_time() methods as a
+    MadFile, plus seek_sample() to jump to an exact sample.
+
+    """
+    def __init__(self, filename, info):
+        self.f = open(filename, 'rb')
+        self.nc, self.sw, self.fr, self.nframes, self.offset = info
+        self.frame = 0
+        self.f.seek(self.offset)
+    def read(self):
+        n = min(4096, self.nframes - self.frame)
+        if n <= 0: return ''
+        self.frame += n
+        return self.f.read(n * self.nc * self.sw)
+    def seek_frame(self, frame):
+        self.frame = max(0, min(frame, self.nframes))
+        self.f.seek(self.offset + self.frame * self.nc * self.sw)
+    def seek_sample(self, pos):
+        """Seek to pos, counted in interleaved samples"""
+        self.seek_frame(pos // self.nc)
+    def seek_time(self, t):
+        """Seek to time t in milliseconds"""
+        self.seek_frame(int(t * self.fr / 1000))
+    def total_time(self):
+        """Return total length in milliseconds"""
+        return self.nframes * 1000 / self.fr
 
 def _create_stream(filename, checks):
     if filename[-3:] in ['wav','WAV']:
-        wf = wave.open(filename, 'rb')
+        info = _cached_wav_info(filename)
+        assert(info is not None) # only PCM WAV files can be streamed
         if checks:
-            assert(wf.getsampwidth() == 2)
-            assert(wf.getnchannels() == gchannels)
-            assert(wf.getframerate() == gsamplerate)
-        # create stream object
-        stream = _Stream()
-        def str_read():
-            return wf.readframes(4096)
-        # give the stream object a read() method
-        stream.read = str_read
-        def str_seek_time(t):
-            if t == 0: wf.rewind()
-            assert(False) # unsupported for WAV streams
-        stream.seek_time = str_seek_time
-        return stream
+            nc, sw, fr, nframes, offset = info
+            assert(sw == 2)
+            assert(nc == gchannels)
+            assert(fr == gsamplerate)
+        return _WavStream(filename, info)
     # Here's how to do it for MP3
     if filename[-3:] in ['mp3','MP3']:
         mf = mad.MadFile(filename)
@@ -418,12 +1129,17 @@ def _create_stream(filename, checks):
 class StreamingSound:
     """Represents a playable sound stream"""
 
-    def __init__(self, filename, checks=True):
+    max_instances = None
+
+    def __init__(self, filename, checks=True, prefetch=0.5):
         """Create new streaming sound from a WAV file or an MP3 file
 
         The new streaming sound must match the output samplerate
         and stereo-ness.  You can turn off these checks by setting
         the keyword checks=False, but the sound will be distorted.
+
+        While playing, each channel decodes the stream in a separate
+        thread, keeping prefetch seconds of audio decoded ahead.
         
         """
         assert(ginit == True)
@@ -431,21 +1147,34 @@ class StreamingSound:
             assert False
         self.filename = filename
         self.checks = checks
+        self.prefetch = prefetch
 
     def get_length(self):
         """Return the length of the sound stream in samples
 
-        Only available for MP3 streams, not WAV ones.  To convert
-        result to seconds, divide by the samplerate and then divide by
-        2.
+        To convert result to seconds, divide by the samplerate and
+        then divide by 2 if in stereo.  For WAV streams this only
+        reads the (cached) file header, MP3 streams have to be
+        opened to find the length.
 
         """
+        if self.filename[-3:] in ['wav','WAV']:
+            nc, sw, fr, nframes, offset = _cached_wav_info(self.filename)
+            return nframes * nc
         stream = _create_stream(self.filename, self.checks)
         t = stream.total_time() * gsamplerate * 2 / 1000
         del(stream)
         return t
 
-    def play(self, volume=1.0, offset=0, fadein=0, envelope=None, loops=0):
+    def set_max_instances(self, n=None):
+        """Limit how many channels can play this stream at once
+
+        Works the same as Sound.set_max_instances().
+
+        """
+        self.max_instances = n
+
+    def play(self, volume=1.0, offset=0, fadein=0, envelope=None, loops=0, priority=0, bus='master', pan=0.0, at_sample=None):
         """Play the sound stream
 
         Keyword arguments:
@@ -455,6 +1184,18 @@ class StreamingSound:
         envelope - a list of [offset, volume] pairs defining
                    a linear volume envelope
         loops - how many times to play the sound (-1 is infinite)
+        priority - when voices are limited, a sound can only take the
+                   voice of one with the same or lower priority
+                   (default 0), see set_max_voices()
+        bus - name of the bus to play on (default 'master'), see Bus
+        pan - stereo position from -1.0 (left) to 1.0 (right),
+              see Channel.set_pan() (default 0.0)
+        at_sample - frame to start on, on the clock returned by
+                    get_clock().  The sound is mixed in exactly there,
+                    even in the middle of a chunk, and heard
+                    get_latency() later like every other mixed
+                    frame.  None or a frame already mixed starts with
+                    the next chunk (default)
 
         """
         stream = _create_stream(self.filename, self.checks)
@@ -469,12 +1210,14 @@ class StreamingSound:
                     env = [[0, volume]]
                 else:
                     env = [[offset, 0.0], [offset + fadein, volume]]
-        src = _SoundSourceStream(stream, loops)
-        src.pos = offset
-        sndevent = Channel(src, env)
-        glock.acquire()
-        gmixer_srcs.append(sndevent)
-        glock.release()
+        buffersize = int(self.prefetch * gsamplerate) * gchannels
+        src = _SoundSourceStream(stream, loops, max(buffersize, gchunksize * gchannels))
+        if offset != 0:
+            src.set_position(offset)
+        sndevent = Channel(src, env, self, priority, bus)
+        sndevent.pan = max(-1.0, min(1.0, pan))
+        sndevent.start = at_sample
+        _command(_start_channel, sndevent)
         return sndevent
 
 def calc_vol(t, env):
@@ -515,62 +1258,591 @@ def microphone_on():
     Schedule audio input during main mixer tick.
 
     """
-    global gstream, gmicstream, gmic
-    glock.acquire()
-    if gmicstream is not None:
-        gmicstream.close()
-    if gstream is not None:
-        gstream.close()
-    gmicstream = gpyaudio.open(
-        format = pyaudio.paInt16,
-        channels = gchannels,
-        rate = gsamplerate,
-        input_device_index = ginput_device_index,
-        input = True)
-    gstream = gpyaudio.open(
-        format = pyaudio.paInt16,
-        channels = gchannels,
-        rate = gsamplerate,
-        output_device_index = goutput_device_index,
-        output = True)
-    gmic = True
-    glock.release()
+    _open_streams(mic=True)
 
 def microphone_off():
     """Turn off microphone"""
-    global gstream, gmicstream, gmic
-    glock.acquire()
-    if gmicstream is not None:
-        gmicstream.close()
-    if gstream is not None:
-        gstream.close()
-    gstream = gpyaudio.open(
-        format = pyaudio.paInt16,
-        channels = gchannels,
-        rate = gsamplerate,
-        output_device_index = goutput_device_index,
-        output = True)
-    gmic = False
-    glock.release()
+    _open_streams(mic=False)
+
+def _capture(data):
+    """Store microphone data read during the current chunk
+
+    The ring keeps two copies of its contents side by side, so any
+    span of up to its capacity can be returned as one contiguous view
+    without copying.
+
+    """
+    global gmiccount, gmiclast
+    smp = numpy.frombuffer(data, dtype=numpy.int16)
+    cap = len(gmicring) // 2
+    n = min(len(smp), cap)
+    smp = smp[len(smp) - n:]
+    i = gmiccount % cap
+    for base in (i, i + cap):
+        k = min(n, 2 * cap - base)
+        gmicring[base:base + k] = smp[:k]
+        gmicring[:n - k] = smp[k:]
+    # output clock when this chunk was captured
+    gmicstamps.append((gmiccount, gframes))
+    gmiclast = (i, n)
+    gmiccount += n
 
 def get_microphone():
     """Return raw data from microphone as Numpy array
 
     Default format will be 16-bit signed mono.  Format will match
     audio playback.  You must call tick() every frame to update the
-    results from this function.
+    results from this function.  Only the most recent chunk is
+    returned, use get_microphone_since() to never miss samples.
+
+    """
+    i, n = gmiclast
+    return gmicring[i:i + n]
+
+def get_microphone_cursor():
+    """Return a cursor for get_microphone_since() pointing at now"""
+    return gmiccount
+
+def get_microphone_since(cursor=0):
+    """Return all microphone samples recorded since cursor
+
+    Returns a tuple (samples, cursor, timestamp).  samples is a Numpy
+    view into the capture buffer holding everything recorded since
+    the given cursor (no copy is made, so use it before more than a
+    buffer's worth of new audio arrives).  cursor is the value to pass
+    next time.  timestamp is the output clock at the first sample, in
+    frames mixed since init() (see get_clock()), or None if there are
+    no new samples.
+
+    If the cursor is so old that samples were overwritten, only the
+    most recent buffer's worth is returned.  The size of the capture
+    buffer is set by init(mic_buffer=...).
 
     """
+    cap = len(gmicring) // 2
+    cursor = max(cursor, gmiccount - cap, 0)
+    count = gmiccount
+    i = cursor % cap
+    samples = gmicring[i:i + count - cursor]
+    if len(samples) == 0:
+        return samples, count, None
+    # find the chunk the first sample came from
+    for c, clock in reversed(gmicstamps):
+        if c <= cursor:
+            return samples, count, clock + (cursor - c) // gchannels
+    c, clock = gmicstamps[0]
+    return samples, count, clock - (c - cursor) // gchannels
+
+def _command(f, *args):
+    """Queue f(*args) to run in the mixer at the start of the next chunk
+
+    Appending to a deque is atomic, so game code controlling sounds
+    never waits for the mixer to finish a chunk.
+
+    """
+    gcommands.append((f, args))
+
+def _run_commands():
+    """Apply all queued channel commands in order"""
+    while True:
+        try:
+            f, args = gcommands.popleft()
+        except IndexError:
+            return
+        f(*args)
+
+def set_max_voices(n=None, policy='oldest'):
+    """Limit how many channels can play at once
+
+    Puts a hard upper bound on the mixing work done for each chunk.
+    When a sound starts while all voices are in use, policy decides
+    what happens:
+      'oldest' - stop the channel that started first
+      'quietest' - stop the channel with the lowest volume
+      'none' - don't play the new sound
+    Only channels with the same or lower priority than the new one
+    are stopped, if there are none the new sound does not play.  A
+    channel that is stopped or never plays has its done attribute set.
+
+    Keyword arguments:
+    n - maximum number of channels, None for no limit (default)
+    policy - 'oldest', 'quietest' or 'none' (default 'oldest')
+
+    """
+    global gmax_voices, gsteal_policy
+    assert (policy in ['oldest', 'quietest', 'none'])
+    gmax_voices = n
+    gsteal_policy = policy
+
+def _steal(chans, chan):
+    """Stop one of chans to make room for chan, return True if done"""
+    if gsteal_policy == 'none': return False
+    victims = [c for c in chans if c.priority <= chan.priority]
+    if len(victims) == 0: return False
+    if gsteal_policy == 'oldest':
+        victim = min(victims, key=lambda c: c.id)
+    else:
+        victim = min(victims, key=lambda c: (c.snapshot[1], c.id))
+    victim._stop()
+    victim.done = True
+    return True
+
+def _start_channel(chan):
+    """Add chan to the mixer unless it is over a voice limit"""
+    snd = chan.sound
+    if snd is not None and snd.max_instances is not None:
+        same = [c for c in gmixer_srcs if c.sound is snd]
+        if len(same) >= snd.max_instances and not _steal(same, chan):
+            chan._stop()
+            chan.done = True
+            return
+    if gmax_voices is not None and len(gmixer_srcs) >= gmax_voices:
+        if not _steal(gmixer_srcs, chan):
+            chan._stop()
+            chan.done = True
+            return
+    gmixer_srcs.append(chan)
+
+def _work_buffers(n, sz):
+    """Return preallocated buffers for mixing n voices of sz samples
+
+    The work buffer has one row per voice.  It only grows (in powers
+    of two) so that a steady number of voices never reallocates.
+    Every bus also gets a buffer of sz samples.
+
+    """
+    global gwork, gvols, gpans, goutbuf
+    if gwork is None or gwork.shape[1] != sz or gwork.shape[0] < n:
+        rows = 16
+        if gwork is not None and gwork.shape[1] == sz:
+            rows = gwork.shape[0]
+        while rows < n:
+            rows *= 2
+        gwork = numpy.zeros((rows, sz), numpy.float32)
+        gvols = numpy.zeros(rows, numpy.float32)
+        gpans = numpy.zeros((rows, 2), numpy.float32)
+    if goutbuf is None or len(goutbuf) != sz:
+        goutbuf = numpy.zeros(sz, numpy.int16)
+    for bus in gbus_order:
+        if bus.buf is None or len(bus.buf) != sz:
+            bus.buf = numpy.zeros(sz, numpy.float32)
+    return gwork, gvols, gpans
+
+def _mix(sz):
+    """Mix all active channels into one chunk of sz samples
+
+    Channels are grouped by bus.  Every playing channel copies its
+    next chunk into its own row of the work buffer and reports its
+    volume, so the rows of each bus are next to each other.  Each bus
+    is then scaled and summed with one matrix product instead of one
+    temporary array per voice, runs its effects, and is added into
+    its parent bus.  Queued channel commands are applied first, and
+    channels scheduled with at_sample wait until the chunk holding
+    their start frame.
+    Returns the master bus buffer and a list of channels that
+    finished during this chunk.  Must be called with glock held.
+
+    """
+    _run_commands()
+    rmlist = []
+    buses = gbus_order
+    for bus in buses:
+        bus.voices = []
+    end = gframes + sz // gchannels
+    for sndevt in gmixer_srcs:
+        if sndevt.active and (sndevt.start is None or sndevt.start < end):
+            sndevt.bus.voices.append(sndevt)
+    work, vols, pans = _work_buffers(len(gmixer_srcs), sz)
+    i = 0
+    for bus in buses:
+        start = i
+        panned = []
+        for sndevt in bus.voices:
+            if sndevt.start is not None:
+                # scheduled start, silence until its frame
+                skip = max(0, sndevt.start - gframes) * gchannels
+                sndevt.start = None
+                work[i, :skip] = 0.0
+                vols[i] = sndevt._get_samples(work[i, skip:])
+            else:
+                vols[i] = sndevt._get_samples(work[i])
+            if sndevt.pan != 0.0 or sndevt.location is not None:
+                panned.append(i)
+            if sndevt.done:
+                rmlist.append(sndevt)
+            i += 1
+        if i == start or bus.muted:
+            bus.buf.fill(0.0)
+        elif len(panned) == 0:
+            numpy.dot(vols[start:i], work[start:i], out=bus.buf)
+        elif gchannels == 1:
+            # mono output only keeps distance attenuation
+            for j in panned:
+                gain, pan = bus.voices[j - start]._placement()
+                vols[j] *= gain
+            numpy.dot(vols[start:i], work[start:i], out=bus.buf)
+        else:
+            # per channel volumes on the interleaved frames, no copies
+            pans[start:i] = vols[start:i, numpy.newaxis]
+            for j in panned:
+                gl, gr = bus.voices[j - start]._pan_gains()
+                pans[j, 0] *= gl
+                pans[j, 1] *= gr
+            frames = work[start:i].reshape(i - start, sz // 2, 2)
+            numpy.einsum('vc,vfc->fc', pans[start:i], frames,
+                         out=bus.buf.reshape(sz // 2, 2))
+    # children come before parents, so each bus is complete when it
+    # is added to its parent
+    for bus in buses:
+        if bus.muted:
+            # also silences whatever child buses added
+            bus.buf.fill(0.0)
+        for f in bus.effects:
+            f(bus.buf)
+        if bus.volume != 1.0:
+            bus.buf *= bus.volume
+        if bus.parent is not None:
+            bus.parent.buf += bus.buf
+    return gbuses['master'].buf, rmlist
+
+class Limiter:
+    """Look-ahead peak limiter
+
+    Turns the volume down smoothly just before peaks that would go
+    over the threshold instead of clipping them, then lets it recover
+    over the release time.  The output is delayed by the lookahead
+    time.  The mixer runs one on its output unless init() is given
+    limiter=False, but a Limiter can also be used as a Bus effect.
+
+    The gain is worked out once per block of frames with a few Numpy
+    operations per chunk, and both channels of stereo get the same
+    gain so the stereo image does not move.
+
+    Keyword arguments:
+    threshold - highest allowed peak as a fraction of full scale
+      (default 0.95)
+    lookahead - seconds of delay used to see peaks coming (default
+      0.002)
+    release - seconds for the gain to recover from silence to full
+      (default 0.1)
+    block - frames sharing one gain point (default 32)
+
+    """
+    def __init__(self, threshold=0.95, lookahead=0.002, release=0.1, block=32):
+        self.threshold = threshold * 32767.0
+        self.block = block
+        # lookahead is a whole number of blocks, at least one
+        nblocks = max(1, int(numpy.ceil(lookahead * gsamplerate / block)))
+        self.lookahead = nblocks * block
+        self.step = block * 1.0 / (release * gsamplerate)
+        self.delay = numpy.zeros((self.lookahead, gchannels), numpy.float32)
+        self.gain = 1.0
+        self.ybuf = None
+    def __call__(self, buf):
+        x = buf.reshape(-1, gchannels)
+        m, d, bs = len(x), self.lookahead, self.block
+        # y is the delay line followed by the new frames
+        if self.ybuf is None or len(self.ybuf) != d + m:
+            self.ybuf = numpy.zeros((d + m, gchannels), numpy.float32)
+        y = self.ybuf
+        y[:d] = self.delay
+        y[d:] = x
+        # peak of each block of frames, padded with silence
+        nb = (d + m + bs - 1) // bs + 1
+        peaks = numpy.zeros(nb * bs, numpy.float32)
+        numpy.abs(y).max(axis=1, out=peaks[:d + m])
+        peaks = peaks.reshape(nb, bs).max(axis=1)
+        # gain point k sits at the start of output block k and must
+        # cover the peaks of block k - 1 up to the end of the lookahead
+        npts = (m + bs - 1) // bs
+        k = numpy.arange(1, npts + 1)
+        win = peaks[k - 1]
+        for j in xrange(d // bs + 1):
+            win = numpy.maximum(win, peaks[numpy.minimum(k + j, nb - 1)])
+        target = numpy.minimum(1.0, self.threshold / numpy.maximum(win, 1.0))
+        # gain falls as needed but rises by at most step per block:
+        # g[k] = min(target[k], g[k-1] + step) without a Python loop
+        kk = numpy.arange(npts + 1)
+        a = numpy.empty(npts + 1)
+        a[0] = self.gain
+        a[1:] = target - k * self.step
+        g = numpy.minimum.accumulate(a) + kk * self.step
+        pos = numpy.minimum(kk * bs, m)
+        gain = numpy.interp(_sample_offsets(m), pos, g)
+        x[:] = y[:m] * gain[:, numpy.newaxis]
+        self.delay[:] = y[m:]
+        self.gain = g[-1]
+
+class _Stats:
+    """Counters describing mixer output, see get_stats()
+
+    Updated once per chunk with a handful of attribute assignments, so
+    keeping them costs nothing noticeable next to mixing.  The
+    histogram is allocated once by set_stats_histogram().
+
+    """
+    def __init__(self):
+        self.hist = None
+        self.hist_max = 0.0
+        self.reset()
+    def reset(self):
+        self.chunks = 0
+        self.underruns = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        # estimated wall clock time when written output runs out
+        self.playend = None
+        self.mix_time = 0.0
+        self.total_mix_time = 0.0
+        self.max_mix_time = 0.0
+        self.lock_wait = 0.0
+        self.max_lock_wait = 0.0
+        self.voices = 0
+        self.max_voices = 0
+        self.retired = 0
+        self.free = None
+        self.max_free = None
+        if self.hist is not None:
+            self.hist.fill(0)
+    def note_mix(self, t, voices, retired):
+        self.chunks += 1
+        self.mix_time = t
+        self.total_mix_time += t
+        if t > self.max_mix_time:
+            self.max_mix_time = t
+        self.voices = voices
+        if voices > self.max_voices:
+            self.max_voices = voices
+        self.retired += retired
+        if self.hist is not None:
+            n = len(self.hist)
+            self.hist[min(n - 1, int(t * n / self.hist_max))] += 1
+    def note_lock_wait(self, t):
+        self.lock_wait = t
+        if t > self.max_lock_wait:
+            self.max_lock_wait = t
+    def note_free(self, frames):
+        # frames of room in the output buffer when a chunk was ready,
+        # the closer to the whole buffer the closer to an underrun,
+        # so the largest value seen is the worst moment.  The buffer
+        # is always empty before the first write, so skip that one
+        if self.playend is None: return
+        self.free = frames
+        if self.max_free is None or frames > self.max_free:
+            self.max_free = frames
+    def set_latency(self, latency):
+        self.latency = latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+    def note_write(self, frames):
+        # Track blocking writes, an underrun is when the
+        # previously written audio finished playing before this write
+        now = time.time()
+        if self.playend is None or now > self.playend:
+            if self.playend is not None:
+                self.underruns += 1
+            self.playend = now
+        self.playend += frames * 1.0 / gsamplerate
+        self.set_latency(self.playend - now + gstream.get_output_latency())
+
+gstats = _Stats()
+
+def set_stats_histogram(nbins=20, max_time=None):
+    """Keep a histogram of chunk mix times in get_stats()
+
+    nbins - number of bins, 0 turns the histogram off (default 20)
+    max_time - upper edge of the last bin in seconds, slower chunks
+      are counted in the last bin (default twice the chunk duration)
+
+    """
+    if nbins == 0:
+        gstats.hist = None
+        return
+    if max_time is None:
+        max_time = 2.0 * gchunksize / gsamplerate
+    gstats.hist_max = max_time
+    gstats.hist = numpy.zeros(nbins, numpy.int64)
+
+def get_stats():
+    """Return a dictionary of counters describing mixer output
+
+    Useful for comparing the blocking and callback output modes and
+    for seeing how close the mixer is to falling behind.  Times are
+    in seconds.
+
+    Keys:
+    mode - output mode given to init()
+    chunks - number of chunks mixed since init()
+    underruns - number of times output ran dry before new audio arrived
+    latency - latest estimate of output latency in seconds
+    max_latency - largest latency estimate seen
+    mix_time - time spent mixing the latest chunk
+    avg_mix_time, max_mix_time - average and largest mix time
+    load - avg_mix_time as a fraction of the chunk duration
+    lock_wait, max_lock_wait - time the mixer waited for the lock
+      before the latest chunk, and the largest wait
+    voices, max_voices - channels mixed in the latest chunk, and the
+      most in any chunk
+    retired - channels that finished playing and were removed
+    free, max_free - free frames in the output buffer when the latest
+      chunk was ready to write, and the most seen.  The closer max_free
+      comes to the whole buffer, the closer the mixer came to running
+      dry.  None in callback mode or before the first tick()
+    histogram - if set_stats_histogram() was called, a pair of
+      (upper bin edges, counts) of mix times, otherwise None
+
+    """
+    avg = 0.0
+    if gstats.chunks > 0:
+        avg = gstats.total_mix_time / gstats.chunks
+    hist = None
+    if gstats.hist is not None:
+        n = len(gstats.hist)
+        edges = [gstats.hist_max * (k + 1) / n for k in range(n)]
+        hist = (edges, gstats.hist.tolist())
+    return {'mode': gmode,
+            'chunks': gstats.chunks,
+            'underruns': gstats.underruns,
+            'latency': gstats.latency,
+            'max_latency': gstats.max_latency,
+            'mix_time': gstats.mix_time,
+            'avg_mix_time': avg,
+            'max_mix_time': gstats.max_mix_time,
+            'load': avg * gsamplerate / gchunksize,
+            'lock_wait': gstats.lock_wait,
+            'max_lock_wait': gstats.max_lock_wait,
+            'voices': gstats.voices,
+            'max_voices': gstats.max_voices,
+            'retired': gstats.retired,
+            'free': gstats.free,
+            'max_free': gstats.max_free,
+            'histogram': hist}
+
+def get_clock():
+    """Return the number of output frames mixed since init()
+
+    This is the mixer's sample clock.  It only moves forward, one
+    chunk at a time, and is the timeline for Sound.play(at_sample=...)
+    and for microphone timestamps.  A frame reaches the speaker about
+    get_latency() seconds after it was mixed, see get_played().  That
+    includes the delay of the output Limiter, so a sound scheduled at
+    frame n comes out of the mixer at frame n + get_output_delay().
+
+    """
+    return gframes
+
+def get_output_delay():
+    """Return frames the output Limiter delays the mix, 0 without one"""
+    if glimiter is None: return 0
+    return glimiter.lookahead
+
+def get_latency():
+    """Return estimated seconds from mixing a frame to hearing it
+
+    The sum of the output device latency and the delay of the output
+    Limiter, see get_output_delay().
+
+    """
+    return gstats.latency + get_output_delay() * 1.0 / gsamplerate
+
+def get_played():
+    """Return an estimate of the output frames heard so far
+
+    Use this to synchronize video to audio: draw the frame for the
+    moment get_played() / samplerate.  It does not depend on the
+    chunk size, so chunks can stay large.
+
+    """
+    return max(0, gframes - int(get_latency() * gsamplerate))
+
+def _mix_output(frames, extra=None):
+    """Mix the next frames of output into the int16 output buffer
+
+    Returns the output buffer, which is reused by the next call.  Must
+    be called with glock held.
+
+    """
+    t0 = time.time()
+    b, rmlist = _mix(frames * gchannels)
+    nvoices = sum([len(bus.voices) for bus in gbus_order])
+    if extra is not None:
+        b += extra
+    if glimiter is not None:
+        glimiter(b)
+    # still clip, limiter output can round a little over
+    numpy.clip(b, -32767.0, 32767.0, out=b)
+    for e in rmlist:
+        e.src.close()
+        gmixer_srcs.remove(e)
+    goutbuf[:] = b
+    global gframes
+    gframes += frames
+    gstats.note_mix(time.time() - t0, nvoices, len(rmlist))
+    return goutbuf
+
+def _output_chunk(frames, extra=None):
+    """Mix the next chunk of output and return it as a string of bytes"""
+    t0 = time.time()
     glock.acquire()
-    d = gmicdata
+    gstats.note_lock_wait(time.time() - t0)
+    odata = _mix_output(frames, extra).tostring()
     glock.release()
-    return numpy.fromstring(gmicdata, dtype=numpy.int16)
-    
+    return odata
+
+def render(seconds, filename=None):
+    """Mix output as fast as possible instead of playing it
+
+    Runs the mixer for the given number of seconds of audio without
+    waiting for the output device and returns the result as a 16-bit
+    Numpy array in the output format.  If filename is given the result
+    is also written to that WAV file.  Sounds play, loop and stop
+    exactly as they would during playback, and streams are always
+    decoded in time, however fast rendering runs.
+
+    Useful for rendering audio offline and for measuring mixer speed.
+    Initialize with sink='null' to run without a sound card, and do
+    not call start() or use callback mode at the same time.
+
+    """
+    assert(ginit == True)
+    frames = int(round(seconds * gsamplerate))
+    out = numpy.zeros(frames * gchannels, numpy.int16)
+    pos = 0
+    global grendering
+    glock.acquire()
+    grendering = True
+    while pos < frames:
+        n = min(gchunksize, frames - pos)
+        out[pos * gchannels:(pos + n) * gchannels] = _mix_output(n)
+        pos += n
+    grendering = False
+    glock.release()
+    if filename is not None:
+        wf = wave.open(filename, 'wb')
+        wf.setnchannels(gchannels)
+        wf.setsampwidth(gsamplewidth)
+        wf.setframerate(gsamplerate)
+        wf.writeframes(out.tostring())
+        wf.close()
+    return out
+
+def _callback(in_data, frame_count, time_info, status):
+    """Stream callback used in callback mode"""
+    if status & _OUTPUT_UNDERFLOW:
+        gstats.underruns += 1
+    if time_info and time_info['output_buffer_dac_time'] > time_info['current_time']:
+        gstats.set_latency(time_info['output_buffer_dac_time'] - time_info['current_time'])
+    if in_data is not None:
+        _capture(in_data)
+    return (_output_chunk(frame_count), _CONTINUE)
+
 def tick(extra=None):
     """Main loop of mixer, mix and do audio IO
 
-    Audio sources are mixed by addition and then clipped.  Too many
-    loud sources will cause distortion.
+    Audio sources are mixed by addition and then passed through a
+    peak limiter (see Limiter), so many loud sources get quieter
+    instead of distorting.  In callback mode the output
+    stream does the mixing and this function does nothing.
 
     extra is for extra sound data to mix into output
       must be in numpy array of correct length
@@ -578,34 +1850,181 @@ def tick(extra=None):
     """
     global ginit
     global gmixer_srcs
-    rmlist = []
-    if not ginit:
+    if not ginit or gmode == 'callback':
         return
-    sz = gchunksize * gchannels
-    b = numpy.zeros(sz, numpy.float)
     if glock is None: return # this can happen if main thread quit first
+    # Streams are only used while holding glock, microphone_on() and
+    # friends may replace them from another thread at any time
+    t0 = time.time()
     glock.acquire()
-    for sndevt in gmixer_srcs:
-        s = sndevt._get_samples(sz)
-        if s is not None:
-            b += s
-        if sndevt.done:
-            rmlist.append(sndevt)
-    if extra is not None:
-        b += extra
-    b = b.clip(-32767.0, 32767.0)
-    for e in rmlist:
-        gmixer_srcs.remove(e)
-    global gmicdata
+    gstats.note_lock_wait(time.time() - t0)
+    if gmic and gmicstream is not None:
+        _capture(gmicstream.read(gchunksize))
+    odata = _mix_output(gchunksize, extra).tostring()
+    stream = gstream
+    first = True
+    while True:
+        if gstream is not stream or stream is None:
+            # streams were reopened, drop this chunk
+            glock.release()
+            return
+        avail = stream.get_write_available()
+        if first:
+            gstats.note_free(avail)
+            first = False
+        if avail >= gchunksize: break
+        # yield rather than block, pyaudio doesn't release GIL
+        glock.release()
+        time.sleep(0.001)
+        glock.acquire()
+    gstats.note_write(gchunksize)
+    stream.write(odata, gchunksize)
+    glock.release()
+
+class _NullStream:
+    """Stand-in for a PyAudio output stream without a sound card
+
+    Output is thrown away, or saved to a WAV file if filename is
+    given.  Playback is paced by the wall clock as if a sound card
+    with a buffer of buffersize frames were draining it.  If callback
+    is given, a thread calls it once per chunk the way PortAudio
+    would, flagging an underflow whenever a callback ran late.
+
+    """
+    def __init__(self, filename=None, callback=None, buffersize=None):
+        self.wf = None
+        if filename is not None:
+            self.wf = wave.open(filename, 'wb')
+            self.wf.setnchannels(gchannels)
+            self.wf.setsampwidth(gsamplewidth)
+            self.wf.setframerate(gsamplerate)
+        self.callback = callback
+        if buffersize is None:
+            buffersize = 2 * gchunksize
+        self.buffersize = buffersize
+        self.running = False
+        self.t0 = None
+        self.frames = 0
+    def _queued(self):
+        # frames written but not yet "played"
+        if self.t0 is None: return 0
+        return self.frames - (time.time() - self.t0) * gsamplerate
+    def get_write_available(self):
+        return max(0, int(self.buffersize - self._queued()))
+    def get_output_latency(self):
+        return 0.0
+    def write(self, data, frames):
+        if self.t0 is None or self._queued() < 0:
+            # ran dry, restart the clock
+            self.t0 = time.time()
+            self.frames = 0
+        self.frames += frames
+        if self.wf is not None:
+            self.wf.writeframes(data)
+    def start_stream(self):
+        if self.callback is None or self.running: return
+        self.running = True
+        thread.start_new_thread(self._run, ())
+    def _run(self):
+        period = gchunksize * 1.0 / gsamplerate
+        deadline = time.time() + period
+        status = 0
+        while self.running:
+            now = time.time()
+            tinfo = {'current_time': now, 'output_buffer_dac_time': deadline}
+            data, flag = self.callback(None, gchunksize, tinfo, status)
+            if not self.running or flag != _CONTINUE: break
+            self.write(data, gchunksize)
+            deadline += period
+            delay = deadline - period - time.time()
+            if delay >= 0:
+                time.sleep(delay)
+                status = 0
+            else:
+                # callback took too long, the "card" ran dry
+                status = _OUTPUT_UNDERFLOW
+                deadline = time.time() + period
+        self.running = False
+    def stop_stream(self):
+        self.running = False
+    def close(self):
+        self.running = False
+        if self.wf is not None:
+            self.wf.close()
+            self.wf = None
+
+def _sink_filename():
+    if gsink == 'null': return None
+    return gsink
+
+def _close_streams():
+    global gstream, gmicstream
+    if gstream is not None:
+        gstream.close()
+        gstream = None
+    if gmicstream is not None:
+        gmicstream.close()
+        gmicstream = None
+
+def _open_streams(mic=None):
+    """Open audio streams to match the current settings
+
+    If mic is given the microphone is turned on or off, at the same
+    time as the streams change so tick() never sees one without the
+    other.
+
+    """
+    global gpyaudio, gstream, gmicstream, gmic
+    # Callbacks take glock while mixing, so a callback stream has to
+    # be closed before taking the lock or closing it would deadlock
+    if gmode == 'callback':
+        _close_streams()
+    glock.acquire()
+    _close_streams()
+    if mic is not None:
+        gmic = mic
+    if gpyaudio is None and (gsink is None or gmic):
+        gpyaudio = pyaudio.PyAudio()
+    if gmode == 'callback':
+        if gsink is None:
+            # Full duplex, microphone data arrives in the callback
+            gstream = gpyaudio.open(
+                format = pyaudio.paInt16,
+                channels = gchannels,
+                rate = gsamplerate,
+                input_device_index = ginput_device_index,
+                output_device_index = goutput_device_index,
+                input = gmic,
+                output = True,
+                frames_per_buffer = gchunksize,
+                stream_callback = _callback)
+        else:
+            assert(not gmic) # no microphone input with null sinks
+            gstream = _NullStream(filename=_sink_filename(), callback=_callback)
+            gstream.start_stream()
+        glock.release()
+        return
+    # It's important to open Input, then Output (not sure why)
+    # Other direction gives very annoying sound errors (1/2 rate?)
     if gmic:
-        gmicdata = gmicstream.read(sz)
+        gmicstream = gpyaudio.open(
+            format = pyaudio.paInt16,
+            channels = gchannels,
+            rate = gsamplerate,
+            input_device_index = ginput_device_index,
+            input = True)
+    if gsink is None:
+        gstream = gpyaudio.open(
+            format = pyaudio.paInt16,
+            channels = gchannels,
+            rate = gsamplerate,
+            output_device_index = goutput_device_index,
+            output = True)
+    else:
+        gstream = _NullStream(filename=_sink_filename())
     glock.release()
-    odata = (b.astype(numpy.int16)).tostring()
-    # yield rather than block, pyaudio doesn't release GIL
-    while gstream.get_write_available() < gchunksize: time.sleep(0.001)
-    gstream.write(odata, gchunksize)
 
-def init(samplerate=44100, chunksize=1024, stereo=True, microphone=False, input_device_index=None, output_device_index=None):
+def init(samplerate=44100, chunksize=1024, stereo=True, microphone=False, input_device_index=None, output_device_index=None, mode='blocking', sink=None, resample_quality=2, limiter=True, mic_buffer=5.0):
     """Initialize mixer
 
     Must be called before any sounds can be played or loaded.
@@ -618,10 +2037,22 @@ def init(samplerate=44100, chunksize=1024, stereo=True, microphone=False, input_
       Can be any size, does not need to be a power of two. (default 1024)
     stereo - whether to play back in stereo
     microphone - whether to enable microphone recording
+    mode - 'blocking' to mix from tick() (default), or 'callback' to
+      have the audio stream call the mixer whenever it needs a chunk
+      (no need for tick() or start())
+    sink - None to play on the sound card (default), 'null' to throw
+      output away without a sound card, or a WAV filename to write
+      output to instead of playing it
+    resample_quality - quality used when loaded sounds have to be
+      resampled to the output samplerate, see resample() (default 2)
+    limiter - whether to run a Limiter on the output instead of just
+      clipping it (default True)
+    mic_buffer - seconds of microphone input kept for
+      get_microphone_since() (default 5.0)
     
     """
     global gstereo, gchunksize, gsamplerate, gchannels, gsamplewidth
-    global ginit
+    global ginit, gmode, gsink, gresample_quality, glimiter
     assert (10000 < samplerate <= 48000)
     gsamplerate = samplerate
     gchunksize = chunksize
@@ -632,33 +2063,38 @@ def init(samplerate=44100, chunksize=1024, stereo=True, microphone=False, input_
     else:
         gchannels = 1
     gsamplewidth = 2
-    global gpyaudio, gstream
-    gpyaudio = pyaudio.PyAudio()
-    # It's important to open Input, then Output (not sure why)
-    # Other direction gives very annoying sound errors (1/2 rate?)
-    global ginput_device_index, goutput_device_index
+    assert (mode in ['blocking', 'callback'])
+    gmode = mode
+    gsink = sink
+    assert (resample_quality in [0, 1, 2, 3])
+    gresample_quality = resample_quality
+    global ginput_device_index, goutput_device_index, gmic
     ginput_device_index = input_device_index
     goutput_device_index = output_device_index
-    if microphone:
-        global gmicstream, gmic
-        gmicstream = gpyaudio.open(
-            format = pyaudio.paInt16,
-            channels = gchannels,
-            rate = gsamplerate,
-            input_device_index = input_device_index,
-            input = True)
-        gmic = True
-    gstream = gpyaudio.open(
-        format = pyaudio.paInt16,
-        channels = gchannels,
-        rate = gsamplerate,
-        output_device_index = output_device_index,
-        output = True)
+    gmic = microphone
+    global gmicring, gmiccount, gmiclast, gmicstamps, gframes
+    # capture ring holds two copies, see _capture()
+    cap = max(int(mic_buffer * gsamplerate), chunksize) * gchannels
+    gmicring = numpy.zeros(2 * cap, numpy.int16)
+    gmiccount = 0
+    gmiclast = (0, 0)
+    gmicstamps = collections.deque(maxlen=cap // (chunksize * gchannels) + 2)
+    gframes = 0
+    gstats.reset()
+    glimiter = None
+    if limiter:
+        glimiter = Limiter()
+    _open_streams()
     ginit = True
 
 def start():
-    """Start separate mixing thread"""
+    """Start separate mixing thread
+
+    Not needed in callback mode, the audio stream drives mixing.
+
+    """
     global gthread
+    if gmode == 'callback': return
     def f():
         while True:
             tick()
@@ -667,21 +2103,23 @@ def start():
 
 def quit():
     """Stop all playback and terminate mixer"""
-    global ginit
+    global ginit, gpyaudio
+    if gmode == 'callback':
+        _close_streams()
     glock.acquire()
     ginit = False
-    if gstream is not None:
-        gstream.close()
-    if gmicstream is not None:
-        gmicstream.close()
-    gpyaudio.terminate()
+    _close_streams()
+    if gpyaudio is not None:
+        gpyaudio.terminate()
+        gpyaudio = None
     glock.release()
 
 def set_chunksize(size=1024):
     """Set the audio chunk size for each frame of audio output
 
     This function is useful for setting the framerate when audio output
-    is synchronized with video.
+    is synchronized with video.  To synchronize without tying the
+    framerate to the chunk size, see get_played() and get_clock().
     """
     global gchunksize
     glock.acquire()
@@ -0,0 +1,182 @@
+import sys
+import time
+import numpy
+import swmixer
+
+# Headless benchmarks of the mixer hot paths
+# Runs against the null output device, no sound card needed.
+# Run all benchmarks, or name some of them on the command line:
+#   python bench.py resample load
+# Throughput is given in samples (frames) per second, and the
+# realtime factor is how many times faster than playback that is.
+
+samplerate = 44100
+chunksize = 1024
+chunktime = chunksize * 1.0 / samplerate
+
+swmixer.init(samplerate=samplerate, chunksize=chunksize, stereo=False, sink="null")
+snd = swmixer.Sound("test1.wav")
+
+def timeit(f, n):
+    """Return average time in seconds of calling f() n times"""
+    f() # warm up
+    t0 = time.time()
+    for i in xrange(n):
+        f()
+    return (time.time() - t0) / n
+
+def report(name, t, samples):
+    """Print throughput of processing samples in t seconds"""
+    print "%-30s %9.3f ms %13.0f samples/sec %8.1fx realtime" % \
+        (name, t * 1000.0, samples / t, samples / t / samplerate)
+
+def mix_time(nvoices, nchunks=50):
+    """Return average time in seconds to mix one chunk of nvoices"""
+    chans = [snd.play(loops=-1, offset=i * 97) for i in range(nvoices)]
+    sz = chunksize * swmixer.gchannels
+    t = timeit(lambda: swmixer._mix(sz), nchunks)
+    for c in chans:
+        c.stop()
+    swmixer._mix(sz) # apply the stops
+    return t
+
+def bench_mix():
+    # Finds how many simultaneous voices can be mixed at 44100 Hz with
+    # 1024 sample chunks before mixing one chunk takes longer than
+    # playing it.
+    print "chunk duration %.2f ms" % (chunktime * 1000.0)
+    n = 1
+    while True:
+        t = mix_time(n)
+        print "%5d voices: %.3f ms per chunk (%.1f%% of realtime)" % \
+            (n, t * 1000.0, 100.0 * t / chunktime)
+        if t > chunktime: break
+        n *= 2
+    # binary search between last good and first bad voice count
+    lo, hi = n / 2, n
+    while hi - lo > 1:
+        mid = (lo + hi) / 2
+        if mix_time(mid) > chunktime:
+            hi = mid
+        else:
+            lo = mid
+    print "max voices sustainable: %d" % lo
+
+def bench_tick():
+    # The whole tick() path including output, paced by the null
+    # device, so use the mixer's own timing from get_stats()
+    for nvoices in [1, 8, 32, 128]:
+        chans = [snd.play(loops=-1, offset=i * 97) for i in range(nvoices)]
+        swmixer.tick()
+        swmixer.gstats.reset()
+        for i in range(40):
+            swmixer.tick()
+        st = swmixer.get_stats()
+        report("tick %d voices" % nvoices, st['avg_mix_time'], chunksize)
+        for c in chans:
+            c.stop()
+        swmixer.tick()
+
+def bench_render():
+    # Offline rendering throughput with a typical game load
+    nvoices = 32
+    chans = [snd.play(loops=-1, offset=i * 97) for i in range(nvoices)]
+    seconds = 20.0
+    t0 = time.time()
+    swmixer.render(seconds)
+    report("render %d voices" % nvoices, time.time() - t0, seconds * samplerate)
+    for c in chans:
+        c.stop()
+
+def bench_limiter():
+    # Cost of the output limiter, should stay a small fraction of a chunk
+    limiter = swmixer.Limiter()
+    buf = (numpy.random.rand(chunksize * swmixer.gchannels) - 0.5) * 200000.0
+    buf = buf.astype(numpy.float32)
+    t = timeit(lambda: limiter(buf), 1000)
+    print "limiter: %.3f ms per chunk (%.1f%% of chunk duration)" % \
+        (t * 1000.0, 100.0 * t / chunktime)
+
+def bench_resample():
+    smp = snd.data[:samplerate]
+    for quality in range(4):
+        t = timeit(lambda: swmixer.resample(smp, 1.5, quality), 5)
+        report("resample quality %d" % quality, t, len(smp))
+
+def bench_interleave():
+    left = snd.data[:samplerate]
+    right = left[::-1].copy()
+    t = timeit(lambda: swmixer.interleave(left, right), 100)
+    report("interleave", t, len(left))
+    both = swmixer.interleave(left, right)
+    t = timeit(lambda: swmixer.uninterleave(both), 100)
+    report("uninterleave", t, len(left))
+    t = timeit(lambda: swmixer.stereo_to_mono(left, right), 100)
+    report("stereo_to_mono", t, len(left))
+
+def bench_calc_vol():
+    # calc_vol is evaluated once per call, count calls as samples
+    env = [[i * 1000, (i % 2) * 1.0] for i in range(10)]
+    n = 10000
+    t = timeit(lambda: [swmixer.calc_vol(i, env) for i in xrange(n)], 5)
+    report("calc_vol 10 points", t, n)
+
+def bench_load():
+    t = timeit(lambda: swmixer.Sound("test1.wav", cache=False), 5)
+    report("load test1.wav", t, len(snd.data))
+    t = timeit(lambda: swmixer.Sound("test1.wav"), 100)
+    report("load test1.wav cached", t, len(snd.data))
+    if not hasattr(swmixer, "mad"):
+        print "load test1.mp3: skipped, pymad not installed"
+        return
+    n = len(swmixer.Sound("test1.mp3", cache=False).data)
+    t = timeit(lambda: swmixer.Sound("test1.mp3", cache=False), 5)
+    report("load test1.mp3", t, n)
+
+def decode_stream(filename):
+    # Read a whole stream the way the decoder thread does
+    stream = swmixer._create_stream(filename, False)
+    n = 0
+    while True:
+        s = stream.read()
+        if s is None or len(s) == 0: break
+        n += len(numpy.frombuffer(s, dtype=numpy.int16))
+    return n
+
+def bench_stream():
+    n = decode_stream("test1.wav")
+    t = timeit(lambda: decode_stream("test1.wav"), 20)
+    report("stream decode test1.wav", t, n)
+    if hasattr(swmixer, "mad"):
+        # MAD returns stereo
+        n = decode_stream("Beat_77.mp3") / 2
+        t = timeit(lambda: decode_stream("Beat_77.mp3"), 2)
+        report("stream decode Beat_77.mp3", t, n)
+    else:
+        print "stream decode Beat_77.mp3: skipped, pymad not installed"
+    # Mixing a stream, with the decoder thread keeping up.
+    # test1.wav is 48000 Hz, skip format checks as only speed matters
+    chans = [swmixer.StreamingSound("test1.wav", checks=False).play(loops=-1)
+             for i in range(8)]
+    seconds = 10.0
+    t0 = time.time()
+    swmixer.render(seconds)
+    report("render 8 streams", time.time() - t0, seconds * samplerate)
+    for c in chans:
+        c.stop()
+
+benchmarks = [('mix', bench_mix),
+              ('tick', bench_tick),
+              ('render', bench_render),
+              ('limiter', bench_limiter),
+              ('resample', bench_resample),
+              ('interleave', bench_interleave),
+              ('calc_vol', bench_calc_vol),
+              ('load', bench_load),
+              ('stream', bench_stream)]
+
+names = sys.argv[1:]
+for name, f in benchmarks:
+    if len(names) == 0 or name in names:
+        print "==", name
+        f()
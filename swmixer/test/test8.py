@@ -0,0 +1,24 @@
+import sys
+import time
+import swmixer
+
+# Compare blocking and callback output modes on the same machine
+# Uses a null sink so no sound card is needed, run with argument
+# "card" to use the real sound card instead.
+
+sink = 'null'
+if len(sys.argv) > 1 and sys.argv[1] == 'card':
+    sink = None
+
+for mode in ['blocking', 'callback']:
+    swmixer.init(samplerate=44100, chunksize=1024, stereo=False, mode=mode, sink=sink)
+    swmixer.start()
+    snd = swmixer.Sound("test1.wav")
+    for i in range(20):
+        snd.play(loops=-1, offset=i * 1000, volume=0.05)
+    time.sleep(5.0)
+    stats = swmixer.get_stats()
+    swmixer.quit()
+    print "%-8s chunks %4d  underruns %3d  latency %.1f ms (max %.1f ms)" % \
+        (mode, stats['chunks'], stats['underruns'],
+         stats['latency'] * 1000.0, stats['max_latency'] * 1000.0)